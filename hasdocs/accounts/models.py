@@ -14,6 +14,8 @@ class Plan(models.Model):
     price = models.DecimalField(max_digits=64, decimal_places=2, default=0)
     # Whether this is a plan for an organization rather than uesr
     business = models.BooleanField(default=False)
+    # Number of builds that may run at the same time
+    concurrent_builds = models.PositiveIntegerField(default=1)
 
     def __unicode__(self):
         return self.name
@@ -167,6 +169,13 @@ class Team(models.Model):
     def __unicode__(self):
         return '%s: %s' % (self.organization, self.name)
 
+    def repo_permissions(self):
+        """Returns the permissions this team has on each of its repos."""
+        if self.permission == self.ADMIN:
+            # Then adds admin permission as well as read permission
+            return ['read', self.ADMIN]
+        return ['read']
+
     @classmethod
     def from_kwargs(cls, organization=None, **kwargs):
         """Returns the existing team for the given kwargs or creates one."""
@@ -1,174 +1,479 @@
 import datetime
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import urlparse
+import zlib
 
 import celery
-import requests
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.utils.timezone import utc
 
-from hasdocs.accounts.models import GroupPermission, Team, User, UserPermission
+from hasdocs.accounts.models import BaseUser, GroupPermission, \
+    Organization, OthersPermission, Team, User, UserPermission
+from hasdocs.core import github
+from hasdocs.core.github import GitHubTask
+from hasdocs.core.tasks import queue_search_shards
 from hasdocs.projects.models import Project
 
 logger = celery.utils.log.get_task_logger(__name__)
 
 
-def github_api_get(url, params=None):
-    """Returns the requested data using GitHub's API."""
-    r = requests.get('%s%s?per_page=100' % (settings.GITHUB_API_URL, url),
-                     params=params)
+def github_api_get_page(url, params, reserve=None):
+    """Returns the data and links of one page from GitHub's API.
+
+    Pages are cached by their URL and parameters, including the access
+    token, along with their ETag and modified date. A cached page is only
+    fetched again if GitHub says it has changed, and GitHub does not count
+    the requests that find it unchanged against the rate limit.
+    """
+    key = 'github:%s' % hashlib.sha1(
+        json.dumps([url, sorted(params.items())])).hexdigest()
+    cached = cache.get(key)
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    r = github.request('GET', url, params=params, reserve=reserve,
+                       headers=headers)
+    if r.status_code == 304 and cached:
+        return json.loads(zlib.decompress(cached['data'])), cached['links']
     if not r.ok:
         logger.warning('From GitHub: %s %s' % (r.status_code, r.reason))
         raise IOError(r.status_code, r.reason)
     data = r.json()
-    while r.links.get('next'):
-        # Then there is more data to fetch
-        r = requests.get(r.links['next']['url'])
-        data += r.json()
+    etag = r.headers.get('etag')
+    last_modified = r.headers.get('last-modified')
+    if etag or last_modified:
+        cache.set(key, {
+            'etag': etag,
+            'last_modified': last_modified,
+            'links': r.links,
+            # Compressed to fit the size limit of cache entries
+            'data': zlib.compress(r.content),
+        }, settings.GITHUB_API_CACHE_TIMEOUT)
+    return data, r.links
+
+
+def github_api_get(url, params=None, reserve=None):
+    """Returns the requested data using GitHub's API.
+
+    When the data spans several pages, the first page links to the last one,
+    and the other pages are then fetched GITHUB_API_CONCURRENCY at a time.
+    Every page is requested with the given parameters, such as the access
+    token, and within the token's budget as github.request leaves it.
+    """
+    params = dict(params or {}, per_page=100)
+    data, links = github_api_get_page(url, params, reserve)
+    if 'last' not in links:
+        return data
+    query = urlparse.urlparse(links['last']['url']).query
+    pages = int(urlparse.parse_qs(query)['page'][0])
+    results = concurrently(
+        lambda page: github_api_get_page(
+            url, dict(params, page=page), reserve),
+        range(2, pages + 1))
+    for page_data, page_links in results:
+        data += page_data
     return data
 
 
-@celery.task
-def sync_user_repos_github(user, payload):
+def concurrently(function, items):
+    """Returns the results of the function for each of the items.
+
+    The function is called from GITHUB_API_CONCURRENCY threads at most.
+    """
+    if not items:
+        return []
+    pool = ThreadPool(min(len(items), settings.GITHUB_API_CONCURRENCY))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def sync_users(members):
+    """Returns the ids of the users for the GitHub accounts.
+
+    Users are created in bulk for the accounts that are new, and are left
+    inactive until they sign in.
+    """
+    ids = set(data['id'] for data in members)
+    existing = set(User.objects.filter(id__in=ids).values_list(
+        'id', flat=True))
+    logins = dict((data['id'], data['login']) for data in members
+                  if data['id'] not in existing)
+    if logins:
+        BaseUser.objects.bulk_create([
+            BaseUser(id=id, login=login, is_active=False)
+            for id, login in logins.iteritems()])
+        # Then the rows of the users themselves, as bulk_create refuses
+        # inherited models for not knowing their ids, which are known here
+        User.objects.all()._batched_insert(
+            [User(baseuser_ptr_id=id) for id in logins],
+            User._meta.local_fields, None)
+    return ids
+
+
+def sync_related(manager, ids):
+    """Makes the ids those of the related objects of the many-to-many manager.
+
+    Returns the numbers of added and removed objects.
+    """
+    current = set(manager.values_list('pk', flat=True))
+    added = ids - current
+    removed = current - ids
+    if removed:
+        manager.remove(*removed)
+    if added:
+        manager.add(*added)
+    return len(added), len(removed)
+
+
+@celery.task(base=GitHubTask)
+def sync_user_repos_github(user_id, payload):
     """Sync the repositories of a user with GitHub."""
+    user = User.objects.get(pk=user_id)
     logger.info('Syncing repositories for %s with GitHub' % user)
     repos = github_api_get('/user/repos?type=owner', params=payload)
-    for repo in repos:
-        project = Project.from_kwargs(**repo)
-        logger.info('Project %s has been synced' % project.name)
-    logger.info('Repositories have been synced for %s' % user)
+    created, updated, stale = Project.objects.sync_repos(user, repos)
+    queue_search_shards(stale)
+    logger.info('Repositories have been synced for %s: %s created, '
+                '%s updated' % (user, created, updated))
 
 
-@celery.task
-def sync_user_collaborators_github(user, payload):
-    """Syncs the collaborators for a user's repos with GitHub."""
+@celery.task(base=GitHubTask)
+def sync_user_collaborators_github(user_id, payload):
+    """Syncs the collaborators for a user's repos with GitHub.
+
+    The collaborators of the repos are fetched concurrently, and only the
+    collaborators and permissions that have changed are written, in bulk.
+    """
+    user = User.objects.get(pk=user_id)
     logger.info('Syncing collaborators for %s with GitHub' % user)
-    for project in user.project_set.all():
-        collaborators = github_api_get('/repos/%s/%s/collaborators' % (
-            user, project), params=payload)
-        path = '/%s/%s/' % (user, project)
-        project.collaborators.clear()
-        UserPermission.objects.filter(path=path).delete()
-        for data in collaborators:
-            collaborator, created = User.objects.get_or_create(
-                login=data['login'], id=data['id'])
-            if collaborator == user:
-                UserPermission.objects.create(
-                    user=user, path=path, permission='admin')
-            elif created:
-                user.is_active = False
-                user.save()
-            UserPermission.objects.create(
-                user=collaborator, path=path, permission='read')
-            project.collaborators.add(collaborator)
-            logger.info('Added %s as a collaborator for %s' % (
-                collaborator, project))
-    logger.info('Collaborators have been synced for %s' % user)
+    projects = list(user.project_set.all())
+    collaborators = concurrently(
+        lambda project: github_api_get('/repos/%s/%s/collaborators' % (
+            user, project), params=payload),
+        projects)
+    Collaborator = Project.collaborators.through
+    with transaction.commit_on_success():
+        sync_users(sum(collaborators, []))
+        # Pairs of project and user, and triples of user, path and permission
+        wanted = set()
+        wanted_perms = set()
+        for project, members in zip(projects, collaborators):
+            path = '/%s/%s/' % (user, project)
+            for data in members:
+                wanted.add((project.pk, data['id']))
+                wanted_perms.add((data['id'], path, 'read'))
+                if data['id'] == user.pk:
+                    wanted_perms.add((user.pk, path, 'admin'))
+        current = dict(
+            ((project_id, member_id), pk)
+            for pk, project_id, member_id in Collaborator.objects.filter(
+                project__in=projects
+            ).values_list('pk', 'project', 'user'))
+        current_perms = dict(
+            ((member_id, member_path, permission), pk)
+            for pk, member_id, member_path, permission in
+            UserPermission.objects.filter(
+                path__in=['/%s/%s/' % (user, project) for project in projects]
+            ).values_list('pk', 'user', 'path', 'permission'))
+        added = wanted - set(current)
+        removed = set(current) - wanted
+        Collaborator.objects.filter(
+            pk__in=[current[key] for key in removed]).delete()
+        Collaborator.objects.bulk_create([
+            Collaborator(project_id=project_id, user_id=member_id)
+            for project_id, member_id in added])
+        UserPermission.objects.filter(pk__in=[
+            current_perms[key]
+            for key in set(current_perms) - wanted_perms]).delete()
+        UserPermission.objects.bulk_create([
+            UserPermission(user_id=member_id, path=member_path,
+                           permission=permission)
+            for member_id, member_path, permission in
+            wanted_perms - set(current_perms)])
+    logger.info('Collaborators have been synced for %s: %s added, '
+                '%s removed' % (user, len(added), len(removed)))
 
 
-@celery.task
-def sync_org_repos_github(org, payload):
+@celery.task(base=GitHubTask)
+def sync_org_repos_github(org_id, payload):
     """Syncs all the repositories of an organization with GitHub."""
+    org = Organization.objects.get(pk=org_id)
     logger.info('Syncing organization repos for %s with GitHub' % org)
     repos = github_api_get('/orgs/%s/repos' % org, payload)
-    for repo in repos:
-        project = Project.from_kwargs(**repo)
-        logger.info('Project %s has been synced' % project.name)
-    logger.info('Organization repos have been synced for %s' % org)
+    created, updated, stale = Project.objects.sync_repos(org, repos)
+    queue_search_shards(stale)
+    logger.info('Organization repos have been synced for %s: %s created, '
+                '%s updated' % (org, created, updated))
 
 
-@celery.task
-def sync_org_members_github(org, payload):
+@celery.task(base=GitHubTask)
+def sync_org_members_github(org_id, payload):
     """Syncs the members of an organization with GitHub."""
+    org = Organization.objects.get(pk=org_id)
     logger.info('Syncing organization members for %s with GitHub' % org)
     members = github_api_get('/orgs/%s/members' % org, params=payload)
     public_members = github_api_get('/orgs/%s/public_members' % org,
                                     params=payload)
-    org.members.clear()
-    org.public_members.clear()
-    for data in members:
-        user, created = User.objects.get_or_create(
-            login=data['login'], id=data['id'])
-        if created:
-            # Then marks this user as being inactive
-            user.is_active = False
-            user.save()
-        org.members.add(user)
-        # Updates the public members list
-        if data in public_members:
-            org.public_members.add(user)
-        logger.info('User %s has been added as member of %s' % (user, org))
-    org.save()
-    logger.info('Organization members have been synced for %s' % org)
-    return org
+    public_ids = set(data['id'] for data in public_members)
+    with transaction.commit_on_success():
+        ids = sync_users(members)
+        added, removed = sync_related(org.members, ids)
+        sync_related(org.public_members, ids & public_ids)
+    logger.info('Organization members have been synced for %s: %s added, '
+                '%s removed' % (org, added, removed))
+    return org.pk
 
 
-@celery.task
-def sync_org_teams_github(org, payload):
-    """Syncs the teams for an organization with GitHub"""
+@celery.task(base=GitHubTask)
+def sync_org_teams_github(org_id, payload):
+    """Syncs the teams for an organization with GitHub.
+
+    The members and repos of the teams are then synced in parallel, by at
+    most GITHUB_TEAM_SYNC_CONCURRENCY tasks, and finish_org_sync_github runs
+    once they have all finished.
+    """
+    org = Organization.objects.get(pk=org_id)
     logger.info('Syncing organization teams for %s with GitHub' % org)
     teams = github_api_get('/orgs/%s/teams' % org, params=payload)
-    for data in teams:
-        team = Team.from_kwargs(organization=org, **data)
-        # Sync team members and repos
-        celery.chain(
-            sync_team_members_github.s(team, payload),
-            sync_team_repos_github.s(team, payload),
-        ).apply_async()
-        logger.info('Team %s has been synced' % team.id)
+    team_ids = [Team.from_kwargs(organization=org, **data).pk
+                for data in teams]
     logger.info('Organization teams have been synced for %s' % org)
+    batches = [team_ids[i::settings.GITHUB_TEAM_SYNC_CONCURRENCY]
+               for i in range(settings.GITHUB_TEAM_SYNC_CONCURRENCY)]
+    header = [sync_teams_github.si(batch, payload)
+              for batch in batches if batch]
+    if header:
+        celery.chord(header)(finish_org_sync_github.si(org.pk))
+    else:
+        finish_org_sync_github.delay(org.pk)
+
+
+@celery.task(base=GitHubTask, ignore_result=False)
+def sync_teams_github(team_ids, payload):
+    """Syncs the members and repos of the teams one after another.
+
+    The teams are synced within this task, so that it is retried as a whole
+    when it is rate limited.
+    """
+    for team_id in team_ids:
+        sync_team_members_github.run(team_id, payload)
+        sync_team_repos_github.run(team_id, payload)
 
 
 @celery.task
-def sync_team_members_github(team, payload):
+def finish_org_sync_github(org_id):
+    """Records that an organization has been synced with GitHub."""
+    Organization.objects.filter(pk=org_id).update(
+        github_sync_date=datetime.datetime.utcnow().replace(tzinfo=utc))
+    logger.info('Organization %s has been synced with GitHub' % org_id)
+
+
+@celery.task(base=GitHubTask)
+def sync_team_members_github(team_id, payload):
     """Syncs a team's member list."""
+    team = Team.objects.get(pk=team_id)
     logger.info('Syncing members for team %s with GitHub' % team)
     members = github_api_get('/teams/%s/members' % team.id, params=payload)
-    team.members.clear()
-    for data in members:
-        member = User.objects.get(id=data['id'])
-        team.members.add(member)
-        logger.info('Member %s has been added to team %s' % (member, team))
-    team.save()
-    logger.info('Members have been synced for team %s' % team)
-    return team.organization
+    with transaction.commit_on_success():
+        added, removed = sync_related(team.members, sync_users(members))
+    logger.info('Members have been synced for team %s: %s added, '
+                '%s removed' % (team, added, removed))
 
 
-@celery.task
-def sync_team_repos_github(org, team, payload):
-    """Syncs a team's repository list."""
+@celery.task(base=GitHubTask)
+def sync_team_repos_github(team_id, payload):
+    """Syncs a team's repository list and its permissions on the repos."""
+    team = Team.objects.select_related('organization').get(pk=team_id)
+    org = team.organization
     logger.info('Syncing repos for team %s with GitHub' % team)
     repos = github_api_get('/teams/%s/repos' % team.id, params=payload)
-    team.project_set.clear()
-    for data in repos:
-        project = Project.objects.get(owner=org, name=data['name'])
-        project.teams.add(team)
+    names = set(data['name'] for data in repos)
+    permissions = team.repo_permissions()
+    with transaction.commit_on_success():
+        projects = dict(Project.objects.filter(
+            owner=org, name__in=names).values_list('pk', 'name'))
+        added, removed = sync_related(team.project_set, set(projects))
+        wanted = set(('/%s/%s/' % (org, name), permission)
+                     for name in projects.itervalues()
+                     for permission in permissions)
+        current = dict(((path, permission), pk) for pk, path, permission in
+                       GroupPermission.objects.filter(group=team).values_list(
+                           'pk', 'path', 'permission'))
+        GroupPermission.objects.filter(pk__in=[
+            current[key] for key in set(current) - wanted]).delete()
+        GroupPermission.objects.bulk_create([
+            GroupPermission(group=team, path=path, permission=permission)
+            for path, permission in wanted - set(current)])
+    logger.info('Repos have been synced for team %s: %s added, '
+                '%s removed' % (team, added, removed))
+
+
+def repo_event(payload):
+    """Applies the creation, change or deletion of a repo to its project."""
+    repo = payload['repository']
+    try:
+        owner = BaseUser.objects.get(pk=repo['owner']['id'])
+    except BaseUser.DoesNotExist:
+        return
+    if payload['action'] == 'deleted':
+        path = '/%s/%s/' % (owner, repo['name'])
+        projects = Project.objects.filter(pk=repo['id'])
+        if projects.filter(private=False).exclude(search_index='').exists():
+            # Then the global index lists the project's docs
+            queue_search_shards([repo['id']])
+        projects.delete()
+        for model in (UserPermission, GroupPermission, OthersPermission):
+            model.objects.filter(path=path).delete()
+    else:
+        old_paths = ['/%s/%s/' % (project.owner, project) for project in
+                     Project.objects.select_related('owner').filter(
+                         pk=repo['id'])]
+        created, updated, stale = Project.objects.sync_repos(owner, [repo])
+        queue_search_shards(stale)
+        path = '/%s/%s/' % (owner, repo['name'])
+        if old_paths and old_paths[0] != path:
+            # Then the repo was renamed or transferred
+            for model in (UserPermission, GroupPermission):
+                model.objects.filter(path=old_paths[0]).update(path=path)
+
+
+def member_event(payload):
+    """Applies the addition or removal of a collaborator on a repo."""
+    try:
+        project = Project.objects.select_related('owner').get(
+            pk=payload['repository']['id'])
+    except Project.DoesNotExist:
+        return
+    member = payload['member']
+    path = '/%s/%s/' % (project.owner, project)
+    if payload['action'] == 'removed':
+        project.collaborators.remove(member['id'])
+        UserPermission.objects.filter(
+            user=member['id'], path=path).delete()
+    elif payload['action'] == 'added':
+        sync_users([member])
+        project.collaborators.add(member['id'])
+        UserPermission.objects.get_or_create(
+            user_id=member['id'], path=path, permission='read')
+
+
+def membership_event(payload):
+    """Applies the addition or removal of a member of a team."""
+    try:
+        team = Team.objects.get(pk=payload['team']['id'])
+    except Team.DoesNotExist:
+        return
+    member = payload['member']
+    if payload['action'] == 'removed':
+        team.members.remove(member['id'])
+    elif payload['action'] == 'added':
+        sync_users([member])
+        team.members.add(member['id'])
+
+
+def organization_event(payload):
+    """Applies the addition or removal of a member of an organization.
+
+    Other actions, such as invitations, are ignored.
+    """
+    try:
+        org = Organization.objects.get(pk=payload['organization']['id'])
+    except Organization.DoesNotExist:
+        return
+    if payload['action'] == 'member_removed':
+        member = payload['membership']['user']
+        org.members.remove(member['id'])
+        org.public_members.remove(member['id'])
+        for team in org.team_set.filter(members=member['id']):
+            team.members.remove(member['id'])
+    elif payload['action'] == 'member_added':
+        member = payload['membership']['user']
+        sync_users([member])
+        org.members.add(member['id'])
+
+
+def team_event(payload):
+    """Applies a change to a team or to the repos it has access to."""
+    try:
+        org = Organization.objects.get(pk=payload['organization']['id'])
+    except Organization.DoesNotExist:
+        return
+    if payload['action'] == 'deleted':
+        Team.objects.filter(pk=payload['team']['id']).delete()
+        return
+    team = Team.from_kwargs(organization=org, **payload['team'])
+    if payload['action'] == 'edited':
+        # Then the team's permission on its repos may have changed
+        paths = ['/%s/%s/' % (org, name) for name in
+                 team.project_set.values_list('name', flat=True)]
+        GroupPermission.objects.filter(group=team).delete()
+        GroupPermission.objects.bulk_create([
+            GroupPermission(group=team, path=path, permission=permission)
+            for path in paths for permission in team.repo_permissions()])
+    elif payload['action'] in ('added_to_repository',
+                               'removed_from_repository'):
+        try:
+            project = Project.objects.get(
+                pk=payload['repository']['id'], owner=org)
+        except Project.DoesNotExist:
+            return
         path = '/%s/%s/' % (org, project)
         GroupPermission.objects.filter(group=team, path=path).delete()
-        if team.permission == 'admin':
-            # Then adds admin permission as well as read permission
-            GroupPermission.objects.create(
-                group=team, path=path, permission=team.permission)
-        GroupPermission.objects.create(
-            group=team, path=path, permission='read')
-        logger.info('Repo %s has been added to team %s' % (project, team))
-    team.save()
-    logger.info('Repos have been synced for team %s' % team)
+        if payload['action'] == 'removed_from_repository':
+            project.teams.remove(team)
+        else:
+            project.teams.add(team)
+            GroupPermission.objects.bulk_create([
+                GroupPermission(group=team, path=path, permission=permission)
+                for permission in team.repo_permissions()])
+
+
+# Handlers of the events of GitHub's webhooks by event name
+EVENT_HANDLERS = {
+    'member': member_event,
+    'membership': membership_event,
+    'organization': organization_event,
+    'repository': repo_event,
+    'team': team_event,
+}
+
+
+@celery.task
+def handle_github_event(event, payload):
+    """Applies the change an event from GitHub's webhooks is about.
+
+    Only the projects, teams, members and permissions the event is about are
+    written, instead of syncing the whole account.
+    """
+    logger.info('Handling %s %s event from GitHub' % (
+        event, payload.get('action')))
+    with transaction.commit_on_success():
+        EVENT_HANDLERS[event](payload)
 
 
 def sync_user_account_github(user, payload):
     """Syncs a user account with GitHub."""
-    sync_user_repos_github(user, payload)
-    sync_user_collaborators_github.delay(user, payload)
+    sync_user_repos_github(user.pk, payload)
+    sync_user_collaborators_github.delay(user.pk, payload)
     user.github_sync_date = datetime.datetime.utcnow().replace(tzinfo=utc)
     user.save()
 
 
 def sync_org_account_github(org, payload):
     """Syncs an organization account with GitHub."""
-    sync_org_repos_github(org, payload)
+    sync_org_repos_github(org.pk, payload)
     celery.chain(
-        sync_org_members_github.s(org, payload),
+        sync_org_members_github.s(org.pk, payload),
         sync_org_teams_github.s(payload),
     ).apply_async()
-    org.github_sync_date = datetime.datetime.utcnow().replace(tzinfo=utc)
-    org.save()
@@ -1,16 +1,407 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import hashlib
+import hmac
+import json
 
-Replace this with more appropriate tests for your application.
-"""
+import mock
 
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import override_settings
 
+from hasdocs.accounts import tasks
+from hasdocs.accounts.models import BaseUser, GroupPermission, \
+    Organization, Team, User, UserPermission
+from hasdocs.projects.models import Project
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+
+def account(id, login):
+    """Returns the data of a GitHub account as listed by its API."""
+    return {'id': id, 'login': login}
+
+
+class GitHubTestCase(TestCase):
+    """Test case answering the GitHub API requests from a dict of URLs."""
+
+    def setUp(self):
+        self.api = {}
+        patcher = mock.patch('hasdocs.accounts.tasks.github_api_get',
+                             lambda url, params=None: self.api[url])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('hasdocs.accounts.tasks.queue_search_shards')
+        self.queue_search_shards = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = {'access_token': 'token'}
+
+
+class GitHubApiGetTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch('hasdocs.accounts.tasks.github')
+        self.github = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = get_cache('django.core.cache.backends.locmem.'
+                               'LocMemCache')
+        self.cache.clear()
+        patcher = mock.patch('hasdocs.accounts.tasks.cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pages = {}
+        self.etags = {}
+        self.github.request.side_effect = self.request
+
+    def request(self, method, url, params, reserve, headers):
+        """Returns the page of the listing given by the parameters."""
+        page = params.get('page', 1)
+        etag = self.etags.get(page)
+        if etag and headers.get('If-None-Match') == etag:
+            return mock.Mock(ok=False, status_code=304)
+        links = {}
+        if page == 1 and len(self.pages) > 1:
+            links['last'] = {'url': '%s?per_page=100&page=%s' % (
+                url, len(self.pages))}
+        content = json.dumps(self.pages[page])
+        return mock.Mock(ok=True, status_code=200, links=links,
+                         headers={'etag': etag}, content=content,
+                         json=lambda: json.loads(content))
+
+    def test_one_page(self):
+        """Tests that a listing on one page takes one request."""
+        self.pages = {1: [1, 2]}
+        self.assertEqual(tasks.github_api_get('/user/repos'), [1, 2])
+        self.assertEqual(self.github.request.call_count, 1)
+
+    def test_pages(self):
+        """Tests that the other pages are fetched with the same params."""
+        self.pages = {1: [1, 2], 2: [3, 4], 3: [5]}
+        self.assertEqual(
+            tasks.github_api_get('/orgs/org/repos', {'access_token': 't'}),
+            [1, 2, 3, 4, 5])
+        for call in self.github.request.call_args_list:
+            self.assertEqual(call[1]['params']['access_token'], 't')
+            self.assertEqual(call[1]['params']['per_page'], 100)
+        self.assertEqual(
+            sorted(call[1]['params'].get('page', 1)
+                   for call in self.github.request.call_args_list), [1, 2, 3])
+
+    def test_revalidate(self):
+        """Tests that unchanged pages are taken from the cache."""
+        self.pages = {1: [1], 2: [2]}
+        self.etags = {1: '"a"', 2: '"b"'}
+        params = {'access_token': 't'}
+        self.assertEqual(tasks.github_api_get('/user/repos', params), [1, 2])
+        self.pages = {1: [0], 2: [3]}
+        self.etags[2] = '"c"'
+        self.assertEqual(tasks.github_api_get('/user/repos', params), [1, 3])
+        # Pages are cached for each access token
+        self.assertEqual(
+            tasks.github_api_get('/user/repos', {'access_token': 'u'}),
+            [0, 3])
+
+    def test_error(self):
+        """Tests that a failed page fails the listing."""
+        self.github.request.side_effect = None
+        self.github.request.return_value = mock.Mock(
+            ok=False, status_code=502, reason='Bad Gateway')
+        self.assertRaises(IOError, tasks.github_api_get, '/user/repos')
+
+
+class SyncUsersTest(TestCase):
+    def test_sync_users(self):
+        """Tests that the new accounts are created as inactive users."""
+        alice = User.objects.create(login='alice')
+        ids = tasks.sync_users([account(alice.pk, 'alice'),
+                                account(100, 'bob')])
+        self.assertEqual(ids, set([alice.pk, 100]))
+        bob = User.objects.get(pk=100)
+        self.assertEqual(bob.login, 'bob')
+        self.assertFalse(bob.is_active)
+        self.assertTrue(User.objects.get(pk=alice.pk).is_active)
+
+    def test_sync_related(self):
+        """Tests that only the changed relations are written."""
+        org = Organization.objects.create(login='org')
+        users = [User.objects.create(login='user%s' % i) for i in range(3)]
+        org.members.add(users[0], users[1])
+        self.assertEqual(
+            tasks.sync_related(org.members, set([users[1].pk, users[2].pk])),
+            (1, 1))
+        self.assertEqual(sorted(org.members.values_list('pk', flat=True)),
+                         [users[1].pk, users[2].pk])
+        self.assertEqual(tasks.sync_related(
+            org.members, set([users[1].pk, users[2].pk])), (0, 0))
+
+
+class SyncCollaboratorsTest(GitHubTestCase):
+    def setUp(self):
+        super(SyncCollaboratorsTest, self).setUp()
+        self.alice = User.objects.create(login='alice')
+        for id, name in ((1, 'one'), (2, 'two')):
+            Project.objects.create(id=id, owner=self.alice, name=name,
+                                   html_url='https://github.com/alice/' + name)
+
+    def permissions(self):
+        return sorted(UserPermission.objects.values_list(
+            'user__login', 'path', 'permission'))
+
+    def test_sync(self):
+        """Tests that collaborators and their permissions are diffed."""
+        self.api = {
+            '/repos/alice/one/collaborators': [
+                account(self.alice.pk, 'alice'), account(100, 'bob')],
+            '/repos/alice/two/collaborators': [
+                account(self.alice.pk, 'alice')],
+        }
+        tasks.sync_user_collaborators_github(self.alice.pk, self.payload)
+        self.assertEqual(self.permissions(), [
+            ('alice', '/alice/one/', 'admin'),
+            ('alice', '/alice/one/', 'read'),
+            ('alice', '/alice/two/', 'admin'),
+            ('alice', '/alice/two/', 'read'),
+            ('bob', '/alice/one/', 'read'),
+        ])
+        self.api['/repos/alice/one/collaborators'] = [
+            account(self.alice.pk, 'alice')]
+        self.api['/repos/alice/two/collaborators'] = [
+            account(self.alice.pk, 'alice'), account(100, 'bob')]
+        tasks.sync_user_collaborators_github(self.alice.pk, self.payload)
+        self.assertEqual(self.permissions(), [
+            ('alice', '/alice/one/', 'admin'),
+            ('alice', '/alice/one/', 'read'),
+            ('alice', '/alice/two/', 'admin'),
+            ('alice', '/alice/two/', 'read'),
+            ('bob', '/alice/two/', 'read'),
+        ])
+        self.assertEqual(list(Project.objects.filter(
+            collaborators=100).values_list('name', flat=True)), ['two'])
+
+
+class SyncOrganizationTest(GitHubTestCase):
+    def setUp(self):
+        super(SyncOrganizationTest, self).setUp()
+        self.org = Organization.objects.create(login='org')
+
+    def test_sync_members(self):
+        """Tests that members and public members are synced."""
+        self.api = {
+            '/orgs/org/members': [account(100, 'bob'), account(101, 'carol')],
+            '/orgs/org/public_members': [account(101, 'carol')],
+        }
+        tasks.sync_org_members_github(self.org.pk, self.payload)
+        self.assertEqual(sorted(self.org.members.values_list('pk', flat=True)),
+                         [100, 101])
+        self.assertEqual(list(self.org.public_members.values_list(
+            'pk', flat=True)), [101])
+        self.api['/orgs/org/members'] = [account(100, 'bob')]
+        tasks.sync_org_members_github(self.org.pk, self.payload)
+        self.assertEqual(list(self.org.members.values_list('pk', flat=True)),
+                         [100])
+        self.assertEqual(self.org.public_members.count(), 0)
+
+    def test_sync_team(self):
+        """Tests that the members, repos and permissions of a team sync."""
+        team = Team.objects.create(id=5, name='Admins', organization=self.org,
+                                   permission='admin')
+        for id, name in ((1, 'one'), (2, 'two')):
+            Project.objects.create(id=id, owner=self.org, name=name,
+                                   html_url='https://github.com/org/' + name)
+        self.api = {
+            '/teams/5/members': [account(100, 'bob')],
+            '/teams/5/repos': [{'name': 'one'}, {'name': 'missing'}],
+        }
+        tasks.sync_teams_github([team.pk], self.payload)
+        self.assertEqual(list(team.members.values_list('pk', flat=True)),
+                         [100])
+        self.assertEqual(list(team.project_set.values_list('pk', flat=True)),
+                         [1])
+        self.assertEqual(sorted(GroupPermission.objects.values_list(
+            'path', 'permission')), [('/org/one/', 'admin'),
+                                     ('/org/one/', 'read')])
+        self.api['/teams/5/repos'] = [{'name': 'two'}]
+        tasks.sync_team_repos_github(team.pk, self.payload)
+        self.assertEqual(sorted(GroupPermission.objects.values_list(
+            'path', 'permission')), [('/org/two/', 'admin'),
+                                     ('/org/two/', 'read')])
+
+    @override_settings(GITHUB_TEAM_SYNC_CONCURRENCY=2)
+    def test_sync_teams_chord(self):
+        """Tests that the teams are synced in batches before the callback."""
+        self.api = {'/orgs/org/teams': [
+            {'id': id, 'name': 'Team %s' % id, 'permission': 'pull'}
+            for id in (5, 6, 7)]}
+        with mock.patch('celery.chord') as chord:
+            tasks.sync_org_teams_github(self.org.pk, self.payload)
+        header = chord.call_args[0][0]
+        self.assertEqual(sorted(signature.args[0] for signature in header),
+                         [[5, 7], [6]])
+        callback = chord.return_value.call_args[0][0]
+        self.assertEqual(callback.task, tasks.finish_org_sync_github.name)
+        self.assertEqual(callback.args, (self.org.pk,))
+        self.assertEqual(Team.objects.count(), 3)
+
+    def test_sync_no_teams(self):
+        """Tests that the callback runs alone without teams to sync."""
+        self.api = {'/orgs/org/teams': []}
+        with mock.patch('celery.chord') as chord:
+            with mock.patch.object(tasks.finish_org_sync_github,
+                                   'delay') as delay:
+                tasks.sync_org_teams_github(self.org.pk, self.payload)
+        self.assertFalse(chord.called)
+        delay.assert_called_once_with(self.org.pk)
+
+
+@override_settings(GITHUB_WEBHOOK_SECRET='s3cret')
+class GitHubEventViewTest(TestCase):
+    def setUp(self):
+        self.client = Client(HTTP_HOST='www.example.com')
+        self.url = reverse('github_event_hook')
+        self.body = json.dumps({'action': 'created'})
+        patcher = mock.patch('hasdocs.accounts.views.handle_github_event')
+        self.handle_github_event = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, event, signature):
+        return self.client.post(
+            self.url, self.body, content_type='application/json',
+            HTTP_X_GITHUB_EVENT=event, HTTP_X_HUB_SIGNATURE=signature)
+
+    def sign(self, secret='s3cret'):
+        return 'sha1=%s' % hmac.new(secret, self.body,
+                                    hashlib.sha1).hexdigest()
+
+    def test_signed(self):
+        """Tests that signed events are handed to the task."""
+        response = self.post('repository', self.sign())
+        self.assertEqual(response.status_code, 200)
+        self.handle_github_event.delay.assert_called_once_with(
+            'repository', {'action': 'created'})
+
+    def test_refused(self):
+        """Tests that events not signed with the secret are refused."""
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.post('repository', '').status_code, 403)
+        self.assertEqual(self.post('repository', self.sign('other')
+                                   ).status_code, 403)
+        with self.settings(GITHUB_WEBHOOK_SECRET=''):
+            self.assertEqual(self.post('repository', self.sign('')
+                                       ).status_code, 403)
+        self.assertFalse(self.handle_github_event.delay.called)
+
+    def test_ignored(self):
+        """Tests that events without a handler are ignored."""
+        response = self.post('push', self.sign())
+        self.assertEqual(response.content, 'Ignored')
+        self.assertFalse(self.handle_github_event.delay.called)
+
+
+class GitHubEventTest(GitHubTestCase):
+    def setUp(self):
+        super(GitHubEventTest, self).setUp()
+        self.org = Organization.objects.create(login='org')
+        self.bob = User.objects.create(id=100, login='bob')
+        self.team = Team.objects.create(id=5, name='Devs',
+                                        organization=self.org,
+                                        permission=Team.PULL)
+        self.team.members.add(self.bob)
+        self.org.members.add(self.bob)
+        self.org.public_members.add(self.bob)
+
+    def repo_event(self, action, name, id=1, owner=None, private=False):
+        owner = owner or self.org
+        tasks.handle_github_event('repository', {
+            'action': action,
+            'repository': {
+                'id': id, 'name': name, 'description': '',
+                'private': private, 'owner': account(owner.pk, owner.login),
+                'html_url': 'https://github.com/%s/%s' % (owner, name),
+                'git_url': 'git://github.com/%s/%s.git' % (owner, name),
+            },
+        })
+
+    def test_repository(self):
+        """Tests that repos are created, renamed and deleted."""
+        self.repo_event('created', 'one')
+        project = Project.objects.get(pk=1)
+        self.assertEqual(project.name, 'one')
+        GroupPermission.objects.create(group=self.team, path='/org/one/',
+                                       permission='read')
+        self.repo_event('renamed', 'two')
+        self.assertEqual(Project.objects.get(pk=1).name, 'two')
+        self.assertEqual(list(GroupPermission.objects.values_list(
+            'path', flat=True)), ['/org/two/'])
+        self.assertFalse(self.queue_search_shards.call_args[0][0])
+        Project.objects.filter(pk=1).update(search_index='index/1.json')
+        self.repo_event('deleted', 'two')
+        self.assertFalse(Project.objects.exists())
+        self.assertFalse(GroupPermission.objects.exists())
+        self.queue_search_shards.assert_called_with([1])
+
+    def test_unknown_owner(self):
+        """Tests that repos of accounts not signed up are ignored."""
+        self.repo_event('created', 'one',
+                        owner=BaseUser(id=999, login='nobody'))
+        self.assertFalse(Project.objects.exists())
+
+    def test_member(self):
+        """Tests that collaborators are added to and removed from repos."""
+        self.repo_event('created', 'one')
+        event = {'repository': {'id': 1}, 'member': account(101, 'carol')}
+        tasks.handle_github_event('member', dict(event, action='added'))
+        self.assertEqual(list(Project.objects.get(pk=1).collaborators.all()),
+                         [User.objects.get(pk=101)])
+        self.assertTrue(UserPermission.objects.filter(
+            user=101, path='/org/one/', permission='read').exists())
+        tasks.handle_github_event('member', dict(event, action='removed'))
+        self.assertFalse(Project.objects.get(pk=1).collaborators.exists())
+        self.assertFalse(UserPermission.objects.exists())
+
+    def test_membership(self):
+        """Tests that members are added to and removed from teams."""
+        event = {'team': {'id': 5}, 'member': account(101, 'carol')}
+        tasks.handle_github_event('membership', dict(event, action='added'))
+        self.assertEqual(sorted(self.team.members.values_list(
+            'pk', flat=True)), [100, 101])
+        tasks.handle_github_event('membership', dict(event, action='removed'))
+        self.assertEqual(list(self.team.members.values_list(
+            'pk', flat=True)), [100])
+
+    def test_organization(self):
+        """Tests that members leave the organization and its teams."""
+        org = account(self.org.pk, 'org')
+        tasks.handle_github_event('organization', {
+            'action': 'member_invited', 'organization': org,
+            'invitation': {'login': 'carol'}})
+        tasks.handle_github_event('organization', {
+            'action': 'member_removed', 'organization': org,
+            'membership': {'user': account(100, 'bob')}})
+        self.assertFalse(self.org.members.exists())
+        self.assertFalse(self.org.public_members.exists())
+        self.assertFalse(self.team.members.exists())
+        tasks.handle_github_event('organization', {
+            'action': 'member_added', 'organization': org,
+            'membership': {'user': account(101, 'carol')}})
+        self.assertEqual(list(self.org.members.values_list('pk', flat=True)),
+                         [101])
+
+    def test_team(self):
+        """Tests that the permissions of teams follow their repos."""
+        self.repo_event('created', 'one')
+        event = {'organization': account(self.org.pk, 'org'),
+                 'team': {'id': 5, 'name': 'Devs', 'permission': 'pull'},
+                 'repository': {'id': 1}}
+        tasks.handle_github_event('team', dict(
+            event, action='added_to_repository'))
+        self.assertEqual(list(GroupPermission.objects.values_list(
+            'path', 'permission')), [('/org/one/', 'read')])
+        event['team']['permission'] = 'admin'
+        tasks.handle_github_event('team', dict(event, action='edited'))
+        self.assertEqual(sorted(GroupPermission.objects.values_list(
+            'path', 'permission')), [('/org/one/', 'admin'),
+                                     ('/org/one/', 'read')])
+        tasks.handle_github_event('team', dict(
+            event, action='removed_from_repository'))
+        self.assertFalse(GroupPermission.objects.exists())
+        self.assertFalse(Team.objects.get(pk=5).project_set.exists())
+        tasks.handle_github_event('team', dict(event, action='deleted'))
+        self.assertFalse(Team.objects.exists())
@@ -1,4 +1,7 @@
 import base64
+import hashlib
+import hmac
+import json
 import logging
 import os
 from threading import Thread
@@ -14,16 +17,18 @@ from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponse, \
     HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
 from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView
 from django.views.generic.edit import UpdateView
 
 from hasdocs.accounts.forms import BillingUpdateForm, ConnectionsUpdateForm, \
     ProfileUpdateForm
 from hasdocs.accounts.models import Organization, User
-from hasdocs.accounts.tasks import github_api_get, sync_user_account_github, \
-    sync_org_account_github
+from hasdocs.accounts.tasks import EVENT_HANDLERS, github_api_get, \
+    handle_github_event, sync_user_account_github, sync_org_account_github
 from hasdocs.projects.models import Project
 
 logger = logging.getLogger(__name__)
@@ -106,7 +111,7 @@ def create_user(access_token):
     """Creates a new user based on GitHub's user data."""
     logger.info('Creating a new user based on data from GitHub')
     payload = {'access_token': access_token}
-    data = github_api_get('/user', params=payload)
+    data = github_api_get('/user', params=payload, reserve=0)
     # Creates a new user based on data from GitHub
     user = User.from_kwargs(github_access_token=access_token, **data)
     # Authenticate and sign in the user
@@ -122,9 +127,10 @@ def create_orgs(user):
     """Creates new organization users based on data from GitHub."""
     logger.info('Creating new organization users based on data from GitHub')
     payload = {'access_token': user.github_access_token}
-    orgs = github_api_get('/user/orgs', params=payload)
+    orgs = github_api_get('/user/orgs', params=payload, reserve=0)
     for org in orgs:
-        data = github_api_get('/orgs/%s' % org['login'], params=payload)
+        data = github_api_get('/orgs/%s' % org['login'], params=payload,
+                              reserve=0)
         organization = Organization.from_kwargs(**data)
         organization.members.add(user)
         sync_org_account_github(organization, payload)
@@ -196,3 +202,30 @@ def sync_account_github(request):
         except IOError as e:
             messages.error(request, 'GitHub: %s' % e.strerror)
         return HttpResponseRedirect(request.user.get_absolute_url())
+
+
+@csrf_exempt
+def github_event(request):
+    """Webhook to be hit by GitHub with the events of accounts and repos.
+
+    Events are only accepted when signed with GITHUB_WEBHOOK_SECRET, and are
+    then applied by a task.
+    """
+    if request.method != 'POST':
+        raise Http404
+    signature = 'sha1=%s' % hmac.new(
+        settings.GITHUB_WEBHOOK_SECRET, request.body, hashlib.sha1
+    ).hexdigest()
+    if not settings.GITHUB_WEBHOOK_SECRET or not constant_time_compare(
+            signature, request.META.get('HTTP_X_HUB_SIGNATURE', '')):
+        logger.warning('Refused an unsigned event from GitHub')
+        return HttpResponseForbidden()
+    event = request.META.get('HTTP_X_GITHUB_EVENT')
+    if event not in EVENT_HANDLERS:
+        return HttpResponse('Ignored')
+    if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+        payload = json.loads(request.body)
+    else:
+        payload = json.loads(request.POST['payload'])
+    handle_github_event.delay(event, payload)
+    return HttpResponse('Thanks')
@@ -0,0 +1,217 @@
+import collections
+import gzip
+import hashlib
+import json
+import os
+import StringIO
+import tarfile
+import threading
+import time
+
+from boto.exception import S3ResponseError
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+
+
+class IndexCache(object):
+    """Indexes kept in memory, dropping the least recently read first.
+
+    Indexes never change once stored, so they are kept by name.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.indexes = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Returns the index if in memory, or None."""
+        with self.lock:
+            index = self.indexes.pop(name, None)
+            if index is not None:
+                self.indexes[name] = index
+            return index
+
+    def add(self, name, index):
+        """Keeps the index, dropping the least recently read if full."""
+        with self.lock:
+            self.indexes[name] = index
+            while len(self.indexes) > self.size:
+                self.indexes.popitem(last=False)
+
+    def clear(self):
+        """Drops all the indexes."""
+        with self.lock:
+            self.indexes.clear()
+
+
+# Recently read archive and search indexes of projects
+indexes = IndexCache(settings.DOCS_ARCHIVE_INDEXES)
+# Recently read shards of the global index, kept apart so that reading the
+# indexes of many projects does not drop them
+shards = IndexCache(settings.SEARCH_SHARDS)
+
+
+def archive_name(spec):
+    """Returns the name of the stored archive for the build of the spec."""
+    return '%s/archives/%s/%s/%s.tar' % (
+        settings.ARTIFACTS_PREFIX, spec['owner'], spec['name'], spec['build'])
+
+
+def index_name(archive):
+    """Returns the name of the stored index of the archive."""
+    return '%s.index.json.gz' % os.path.splitext(archive)[0]
+
+
+def blob_name(digest):
+    """Returns the name of the stored blob with the given content hash."""
+    return '%s/blobs/%s' % (settings.ARTIFACTS_PREFIX, digest)
+
+
+def is_shared(path):
+    """Returns whether the file is likely to be the same in many projects."""
+    return os.path.splitext(path)[1].lower() in settings.DOCS_BLOB_EXTENSIONS
+
+
+def file_digest(path):
+    """Returns the SHA-1 hash of the content of the file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for data in iter(lambda: fp.read(64 * 1024), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def create_archive(local_base, filename):
+    """Archives the files under local_base and returns the archive's index.
+
+    The archive is an uncompressed tarball, so that each file can be read
+    back with a single ranged read. The index maps the path of each file to
+    the offset and size of its data in the archive. Files that are likely to
+    be shared with other projects, such as scripts, stylesheets and fonts,
+    are left out of the archive and indexed by the hash of their content.
+
+    Returns the index and a dictionary of the local paths of those files by
+    their hashes, which are to be stored as blobs.
+    """
+    index = {}
+    blobs = {}
+    with tarfile.open(filename, 'w') as tar:
+        for root, dirs, names in os.walk(local_base):
+            for name in names:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, local_base)
+                if is_shared(path):
+                    digest = file_digest(path)
+                    index[relpath] = digest
+                    blobs[digest] = path
+                else:
+                    tar.add(path, arcname=relpath)
+    with tarfile.open(filename) as tar:
+        for member in tar:
+            if member.isfile():
+                index[member.name] = [member.offset_data, member.size]
+    return index, blobs
+
+
+def touch_blob(storage, key):
+    """Copies a stored blob onto itself, renewing its last modified time."""
+    storage.bucket.copy_key(
+        key.name, storage.bucket.name, key.name, metadata=key.metadata,
+        headers={'Content-Type': key.content_type},
+        storage_class=('REDUCED_REDUNDANCY' if storage.reduced_redundancy
+                       else 'STANDARD'))
+
+
+def store_blob(storage, digest, path):
+    """Stores the file as a blob unless it is stored already.
+
+    A blob that is reused is touched, unless it was lately, so that the
+    garbage collector keeps it until the archive reusing it is published,
+    which happens within BUILD_TIMEOUT. Returns whether the file was
+    uploaded.
+    """
+    name = blob_name(digest)
+    key = 'blob-stored:%s' % digest
+    now = time.time()
+    if now - (cache.get(key) or 0) < (settings.DOCS_GC_GRACE_PERIOD -
+                                      settings.BUILD_TIMEOUT):
+        return False
+    stored = storage.bucket.get_key(name)
+    if stored is None:
+        with open(path, 'rb') as fp:
+            storage.save(name, File(fp))
+        uploaded = True
+    else:
+        touch_blob(storage, stored)
+        uploaded = False
+    cache.set(key, now, settings.DOCS_ARCHIVE_CACHE_TIMEOUT)
+    return uploaded
+
+
+def dump_index(index):
+    """Returns the compressed JSON of the index."""
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+        json.dump(index, fp, separators=(',', ':'))
+    return buf.getvalue()
+
+
+def load_index(storage, name, memory=indexes):
+    """Returns a stored index from memory, cache or storage."""
+    index = memory.get(name)
+    if index is not None:
+        return index
+    data = cache.get(name)
+    if data is None:
+        with storage.open(name, 'rb') as fp:
+            data = fp.read()
+        cache.set(name, data, settings.DOCS_ARCHIVE_CACHE_TIMEOUT)
+    index = json.load(gzip.GzipFile(fileobj=StringIO.StringIO(data)))
+    memory.add(name, index)
+    return index
+
+
+def read_range(storage, name, offset, size):
+    """Returns size bytes from offset of a stored file with a ranged read."""
+    if not size:
+        return ''
+    key = storage.bucket.new_key(name)
+    try:
+        return key.get_contents_as_string(headers={
+            'Range': 'bytes=%d-%d' % (offset, offset + size - 1)})
+    except S3ResponseError as e:
+        raise IOError(e.status, e.reason)
+
+
+def read_blob(storage, digest):
+    """Returns the content of a blob from cache or storage.
+
+    Blobs are cached by their hash, so a file shared by many projects takes
+    a single slot in the cache.
+    """
+    key = 'blob:%s' % digest
+    content = cache.get(key)
+    if content is None:
+        with storage.open(blob_name(digest), 'rb') as fp:
+            content = fp.read()
+        cache.add(key, content, settings.DOCS_ARCHIVE_CACHE_TIMEOUT)
+    return content
+
+
+def read_member(storage, archive, path):
+    """Returns a file of the archive from cache or with a ranged read."""
+    key = 'archive:%s' % hashlib.sha1(
+        ('%s:%s' % (archive, path)).encode('utf-8')).hexdigest()
+    content = cache.get(key)
+    if content is None:
+        entry = load_index(storage, index_name(archive)).get(path)
+        if entry is None:
+            raise IOError('%s is not in %s' % (path, archive))
+        if not isinstance(entry, list):
+            # Then the file is stored as a blob
+            return read_blob(storage, entry)
+        content = read_range(storage, archive, *entry)
+        cache.add(key, content, settings.DOCS_ARCHIVE_CACHE_TIMEOUT)
+    return content
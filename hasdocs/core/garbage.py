@@ -0,0 +1,228 @@
+import datetime
+import json
+import logging
+import time
+
+from boto.s3.prefix import Prefix
+from boto.utils import parse_ts
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from hasdocs.core import archives
+from hasdocs.projects.models import Build, Project, SearchShard
+
+logger = logging.getLogger(__name__)
+
+
+class Collector(object):
+    """Deletes keys from a bucket in batches, at a limited rate.
+
+    At most DOCS_GC_MAX_DELETES keys are deleted in one collection, in
+    batches of DOCS_GC_BATCH_SIZE keys with DOCS_GC_BATCH_DELAY seconds
+    between them. In a dry run, the keys are only logged.
+    """
+
+    def __init__(self, bucket, dry_run=False):
+        self.bucket = bucket
+        self.dry_run = dry_run
+        self.pending = []
+        self.deleted = 0
+        self.bytes = 0
+        self.started = datetime.datetime.utcnow()
+
+    def is_full(self):
+        """Returns whether no more keys can be deleted in this collection."""
+        return (self.deleted + len(self.pending) >=
+                settings.DOCS_GC_MAX_DELETES)
+
+    def is_old(self, key, age=None):
+        """Returns whether the key was last modified before the given age.
+
+        The age defaults to DOCS_GC_GRACE_PERIOD seconds, which keeps what
+        builds that are still running have uploaded.
+        """
+        age = age or datetime.timedelta(seconds=settings.DOCS_GC_GRACE_PERIOD)
+        return parse_ts(key.last_modified) < self.started - age
+
+    def delete(self, key):
+        """Queues the key for deletion, unless the collection is full."""
+        if self.is_full():
+            return
+        self.pending.append(key)
+        if len(self.pending) >= settings.DOCS_GC_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Deletes the queued keys as one batch."""
+        if not self.pending:
+            return
+        names = [key.name for key in self.pending]
+        if self.dry_run:
+            for name in names:
+                logger.info('Would delete %s' % name)
+        else:
+            result = self.bucket.delete_keys(names, quiet=True)
+            for error in result.errors:
+                logger.warning('Failed to delete %s: %s' % (
+                    error.key, error.message))
+            time.sleep(settings.DOCS_GC_BATCH_DELAY)
+        self.deleted += len(names)
+        self.bytes += sum(int(key.size) for key in self.pending)
+        self.pending = []
+
+
+def list_prefixes(bucket, prefix):
+    """Returns the names of the prefixes right under the given prefix."""
+    return [item.name for item in bucket.list(prefix=prefix, delimiter='/')
+            if isinstance(item, Prefix)]
+
+
+def collect_published(collector, projects):
+    """Deletes the separately published files that are no longer served.
+
+    These are the files of deleted projects, of projects now published as
+    archives, and the files older than the latest upload of a project's
+    docs, which that upload did not replace.
+    """
+    published_at = dict(
+        ((owner, name), uploaded_at)
+        for owner, name, uploaded_at in Project.objects.exclude(
+            published_at=None
+        ).values_list('owner__login', 'name', 'published_at'))
+    for owner_prefix in list_prefixes(collector.bucket, ''):
+        if owner_prefix == '%s/' % settings.ARTIFACTS_PREFIX:
+            continue
+        for prefix in list_prefixes(collector.bucket, owner_prefix):
+            project = tuple(prefix.rstrip('/').split('/'))
+            if project in projects and not projects[project]:
+                # Then the project is still published as separate files
+                uploaded_at = published_at.get(project)
+                if not uploaded_at:
+                    continue
+                age = timezone.now() - uploaded_at
+            else:
+                age = None
+            for key in collector.bucket.list(prefix=prefix):
+                if collector.is_full():
+                    return
+                if collector.is_old(key, age):
+                    collector.delete(key)
+
+
+def collect_archives(collector, projects):
+    """Deletes the archives that are not published.
+
+    Returns the names of the archives that are kept.
+    """
+    kept = set()
+    prefix = '%s/archives/' % settings.ARTIFACTS_PREFIX
+    for key in collector.bucket.list(prefix=prefix):
+        owner, name, filename = key.name[len(prefix):].split('/', 2)
+        archive = projects.get((owner, name))
+        if archive and key.name in (archive, archives.index_name(archive)):
+            kept.add(archive)
+        elif collector.is_old(key):
+            collector.delete(key)
+        elif key.name.endswith('.tar'):
+            # Then the archive may be published by a running build
+            kept.add(key.name)
+    return kept
+
+
+def is_still_old(collector, key):
+    """Returns whether the key is still old when it is listed again."""
+    for listed in collector.bucket.list(prefix=key.name):
+        if listed.name == key.name:
+            return collector.is_old(listed)
+    return False
+
+
+def collect_blobs(collector, storage, kept):
+    """Deletes the blobs that none of the kept archives refers to.
+
+    Blobs are listed again before they are deleted, since a build that
+    reuses a blob touches it before publishing the archive referring to it.
+    """
+    prefix = '%s/blobs/' % settings.ARTIFACTS_PREFIX
+    candidates = [key for key in collector.bucket.list(prefix=prefix)
+                  if collector.is_old(key)]
+    if not candidates:
+        return
+    referenced = set()
+    for archive in kept:
+        try:
+            index = archives.load_index(
+                storage, archives.index_name(archive))
+        except IOError:
+            logger.warning('Failed to read the index of %s' % archive)
+            # Then the blobs it refers to are unknown
+            return
+        referenced.update(entry for entry in index.itervalues()
+                          if not isinstance(entry, list))
+    for key in candidates:
+        digest = key.name[len(prefix):]
+        if digest not in referenced and is_still_old(collector, key):
+            collector.delete(key)
+            if not collector.dry_run:
+                cache.delete('blob-stored:%s' % digest)
+
+
+def collect_unpublished(collector, kind, published):
+    """Deletes the artifacts of the given kind that are not published."""
+    prefix = '%s/%s/' % (settings.ARTIFACTS_PREFIX, kind)
+    for key in collector.bucket.list(prefix=prefix):
+        if key.name not in published and collector.is_old(key):
+            collector.delete(key)
+
+
+def collect_sphinx_envs(collector, projects):
+    """Deletes the Sphinx environments of deleted projects."""
+    prefix = '%s/sphinx/' % settings.ARTIFACTS_PREFIX
+    for key in collector.bucket.list(prefix=prefix):
+        owner, filename = key.name[len(prefix):].split('/', 1)
+        name = filename[:-len('.tar.gz')]
+        if (owner, name) not in projects and collector.is_old(key):
+            collector.delete(key)
+
+
+def collect_virtualenvs(collector):
+    """Deletes the virtualenvs that no recent build has used."""
+    age = datetime.timedelta(seconds=settings.DOCS_GC_VIRTUALENV_AGE)
+    used = set()
+    for spec in Build.objects.filter(
+        finished_at__gte=timezone.now() - age
+    ).exclude(spec='').values_list('spec', flat=True):
+        used.add(json.loads(spec).get('venv_key'))
+    prefix = '%s/venvs/' % settings.ARTIFACTS_PREFIX
+    for key in collector.bucket.list(prefix=prefix):
+        venv_key = key.name[len(prefix):-len('.tar.gz')]
+        if venv_key not in used and collector.is_old(key, age):
+            collector.delete(key)
+
+
+def collect(storage, dry_run=False):
+    """Deletes what is stored but neither published nor referenced.
+
+    Returns the collector, which counts the deleted keys and bytes.
+    """
+    collector = Collector(storage.bucket, dry_run)
+    projects = {}
+    indexes = set(SearchShard.objects.values_list('index', flat=True))
+    bundles = set()
+    for owner, name, archive, index, bundle in Project.objects.values_list(
+            'owner__login', 'name', 'docs_archive', 'search_index',
+            'offline_bundle'):
+        projects[(owner, name)] = archive
+        indexes.add(index)
+        bundles.add(bundle)
+    collect_published(collector, projects)
+    kept = collect_archives(collector, projects)
+    collect_blobs(collector, storage, kept)
+    collect_unpublished(collector, 'search', indexes)
+    collect_unpublished(collector, 'offline', bundles)
+    collect_sphinx_envs(collector, projects)
+    collect_virtualenvs(collector)
+    collector.flush()
+    return collector
@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import random
+import time
+
+import celery
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+
+from hasdocs.core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Connections to GitHub's API, kept open for the following requests
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_maxsize=settings.GITHUB_API_CONCURRENCY))
+
+
+class RateLimited(IOError):
+    """Raised when a request would exceed a rate limit of GitHub's API.
+
+    The wait is the number of seconds until the limit is lifted, if known.
+    """
+
+    def __init__(self, wait=None):
+        if wait is None:
+            IOError.__init__(self, 'Rate limited by GitHub')
+        else:
+            IOError.__init__(
+                self, 'Rate limited by GitHub for %d seconds' % wait)
+        self.wait = wait
+
+
+def budget_key(params):
+    """Returns the cache key of the budget of the request's token."""
+    token = (params or {}).get('access_token', '')
+    return 'github-budget:%s' % hashlib.sha1(token).hexdigest()
+
+
+def request(method, path, params=None, reserve=None, **kwargs):
+    """Sends a request to GitHub's API within the rate limit of its token.
+
+    Returns the response. The remaining budget of each token is kept from
+    the responses to its requests, and the last reserve requests of it, which
+    default to GITHUB_API_RESERVE, are left to the requests users wait for.
+    RateLimited is raised instead of sending a request beyond that until the
+    budget is reset, and when GitHub turns a request down for exceeding its
+    primary or secondary rate limits.
+    """
+    if reserve is None:
+        reserve = settings.GITHUB_API_RESERVE
+    key = budget_key(params)
+    budget = cache.get(key)
+    now = time.time()
+    if budget and budget['remaining'] <= reserve and budget['reset'] > now:
+        raise RateLimited(budget['reset'] - now)
+    r = session.request(method, '%s%s' % (settings.GITHUB_API_URL, path),
+                        params=params, **kwargs)
+    remaining = r.headers.get('x-ratelimit-remaining')
+    reset = int(r.headers.get('x-ratelimit-reset') or 0)
+    if remaining is not None:
+        cache.set(key, {'remaining': int(remaining), 'reset': reset},
+                  max(1, int(reset - now)))
+        metrics.record('GitHub/RateLimit/Remaining', int(remaining))
+    if r.status_code in (403, 429):
+        if r.headers.get('retry-after'):
+            # Then a secondary rate limit was exceeded
+            metrics.record('GitHub/RateLimit/Secondary', 1)
+            raise RateLimited(int(r.headers['retry-after']))
+        if remaining == '0':
+            metrics.record('GitHub/RateLimit/Exceeded', 1)
+            raise RateLimited(max(0, reset - now))
+        if 'rate limit' in r.text.lower():
+            metrics.record('GitHub/RateLimit/Secondary', 1)
+            raise RateLimited()
+    return r
+
+
+def retry_delay(exc, retries):
+    """Returns the seconds to wait before retrying a rate limited request.
+
+    Without a known wait, the delay doubles with each retry. Some jitter is
+    added so that the requests waiting on the same limit are spread out.
+    """
+    if exc.wait is None:
+        wait = settings.GITHUB_API_BACKOFF * 2 ** retries
+    else:
+        wait = exc.wait
+    return int(wait + random.uniform(0, settings.GITHUB_API_JITTER))
+
+
+class GitHubTask(celery.Task):
+    """Base class for the tasks that sync with GitHub.
+
+    A task that is rate limited is retried once the limit is lifted. When it
+    is run directly rather than by a worker, it is queued for then instead.
+    """
+    abstract = True
+    max_retries = settings.GITHUB_API_RETRIES
+
+    def __call__(self, *args, **kwargs):
+        """Runs the task, deferring it when it is rate limited."""
+        try:
+            return super(GitHubTask, self).__call__(*args, **kwargs)
+        except RateLimited as exc:
+            countdown = retry_delay(exc, self.request.retries)
+            logger.warning('Task %s deferred for %s seconds: %s' % (
+                self.name, countdown, exc))
+            if self.request.called_directly:
+                self.apply_async(args, kwargs, countdown=countdown)
+                return None
+            raise self.retry(exc=exc, countdown=countdown)
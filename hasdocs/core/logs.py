@@ -0,0 +1,119 @@
+import codecs
+import collections
+import time
+
+from django.conf import settings
+from django.db.models import F, Max
+
+from hasdocs.projects.models import Build, LogChunk
+
+
+class BuildLog(object):
+    """Buffers the output of a build and flushes it in batches.
+
+    Lines are pushed to the subscribers of the build's channel at most every
+    BUILD_LOG_FLUSH_INTERVAL seconds or BUILD_LOG_FLUSH_SIZE bytes, and are
+    stored as a compressed LogChunk every BUILD_LOG_CHUNK_SIZE bytes. Only
+    the last BUILD_LOG_TAIL_SIZE bytes are kept in memory and on the build.
+    """
+
+    def __init__(self, build_id, channel):
+        self.build_id = build_id
+        self.channel = channel
+        # Decoder keeping the bytes of a character split between reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # Output that has not been split into complete lines yet
+        self.partial = u''
+        # Lines waiting to be pushed to the subscribers
+        self.pending = []
+        self.pending_size = 0
+        # Lines waiting to be stored in the database
+        self.unsaved = []
+        self.unsaved_size = 0
+        # Bounded tail of the output, as lines with their sizes
+        self.tail_lines = collections.deque()
+        self.tail_size = 0
+        # Chunks follow those stored by earlier attempts of the build
+        last = LogChunk.objects.filter(build=build_id).aggregate(
+            Max('number'))['number__max']
+        self.chunks = 0 if last is None else last + 1
+        self.flushed_at = time.time()
+
+    def write(self, data):
+        """Adds raw output from the build to the buffers."""
+        self.partial += self.decoder.decode(data)
+        if '\n' not in self.partial:
+            if len(self.partial) < settings.BUILD_LOG_FLUSH_SIZE:
+                return
+            # Then a very long line is split to keep the buffer bounded
+            text, self.partial = self.partial, u''
+        else:
+            text, self.partial = self.partial.rsplit('\n', 1)
+            text += '\n'
+        self._append(text)
+        if self.pending_size >= settings.BUILD_LOG_FLUSH_SIZE:
+            self.flush()
+        if self.unsaved_size >= settings.BUILD_LOG_CHUNK_SIZE:
+            self.save()
+
+    def _append(self, text):
+        """Appends complete lines of text to each buffer.
+
+        Sizes are counted in bytes of the UTF-8 encoded text, as stored.
+        """
+        size = len(text.encode('utf-8'))
+        self.pending.append(text)
+        self.pending_size += size
+        self.unsaved.append(text)
+        self.unsaved_size += size
+        self.tail_lines.append((text, size))
+        self.tail_size += size
+        while (self.tail_size > settings.BUILD_LOG_TAIL_SIZE and
+               len(self.tail_lines) > 1):
+            self.tail_size -= self.tail_lines.popleft()[1]
+
+    def timeout(self):
+        """Returns the number of seconds until the next flush is due."""
+        elapsed = time.time() - self.flushed_at
+        return max(0, settings.BUILD_LOG_FLUSH_INTERVAL - elapsed)
+
+    def flush_if_due(self):
+        """Flushes the pending lines if the flush interval has passed."""
+        if not self.timeout():
+            self.flush()
+
+    def flush(self):
+        """Pushes the pending lines to the subscribers as one message."""
+        self.flushed_at = time.time()
+        if not self.pending:
+            return
+        message = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.channel.trigger('log', {'message': message})
+
+    def save(self):
+        """Stores the unsaved lines as a chunk and updates the build's tail."""
+        if not self.unsaved:
+            return
+        chunk = LogChunk.from_text(
+            self.build_id, self.chunks, ''.join(self.unsaved))
+        chunk.save()
+        self.chunks += 1
+        self.unsaved = []
+        self.unsaved_size = 0
+        Build.objects.filter(pk=self.build_id).update(
+            output=self.tail(), output_size=F('output_size') + chunk.size)
+
+    def close(self):
+        """Flushes and stores whatever is left in the buffers."""
+        self.partial += self.decoder.decode('', True)
+        if self.partial:
+            text, self.partial = self.partial, u''
+            self._append(text)
+        self.flush()
+        self.save()
+
+    def tail(self):
+        """Returns the last part of the output kept in memory."""
+        return ''.join(text for text, size in self.tail_lines)
@@ -0,0 +1,77 @@
+import logging
+import resource
+import threading
+import time
+
+import newrelic.agent
+
+logger = logging.getLogger(__name__)
+
+# Usage of the build stage running in each thread
+_stages = threading.local()
+
+
+def record(name, value):
+    """Records a custom metric with New Relic for the current transaction."""
+    logger.debug('Metric %s: %s' % (name, value))
+    newrelic.agent.record_custom_metric('Custom/%s' % name, value)
+
+
+class StageUsage(object):
+    """Measures the time and resources used by a stage of a build.
+
+    The tasks of the stage report the bytes they transfer, the files they
+    handle and the resource usage of the child processes they wait for. The
+    peak memory is that of those child processes only, as the peak of the
+    worker itself is over its whole life rather than the stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.files = 0
+        self.peak_rss = 0
+        self.wall = 0
+        self.cpu = 0
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_cpu = _cpu_time()
+        _stages.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _stages.current = None
+        self.wall = time.time() - self.started
+        self.cpu = _cpu_time() - self.start_cpu
+        record('Builds/Stages/%s/WallTime' % self.name, self.wall)
+        record('Builds/Stages/%s/CpuTime' % self.name, self.cpu)
+
+    def add_child(self, usage):
+        """Accounts for the peak memory of a child process waited for."""
+        self.peak_rss = max(self.peak_rss, usage.ru_maxrss)
+
+    def stats(self):
+        """Returns the measurements as a dictionary."""
+        return {
+            'stage': self.name,
+            'wall': round(self.wall, 3),
+            'cpu': round(self.cpu, 3),
+            'peak_rss': self.peak_rss,
+            'bytes': self.bytes,
+            'files': self.files,
+        }
+
+
+def current_stage():
+    """Returns the usage of the build stage running in this thread."""
+    return _stages.current
+
+
+def _cpu_time():
+    """Returns the CPU time used by this process and its waited children."""
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
@@ -0,0 +1 @@
+"""The core app has no models; this module lets its tests be found."""
@@ -0,0 +1,309 @@
+import bisect
+import heapq
+import HTMLParser
+import itertools
+import math
+import os
+import re
+import uuid
+
+from django.conf import settings
+
+# Words of the text, ignoring case and punctuation
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Pages generated by Sphinx that only list the other pages
+SKIPPED_PAGES = ('genindex.html', 'py-modindex.html', 'search.html')
+
+
+class TextExtractor(HTMLParser.HTMLParser):
+    """Extracts the title and the visible text of an HTML page."""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.title = []
+        self.text = []
+        self.skipping = 0
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skipping += 1
+        elif tag == 'title':
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            self.skipping = max(0, self.skipping - 1)
+        elif tag == 'title':
+            self.in_title = False
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+        elif not self.skipping:
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+
+def tokenize(text):
+    """Returns the lowercased words of the text that are worth indexing."""
+    return [word for word in WORD_RE.findall(text.lower())
+            if 1 < len(word) <= settings.SEARCH_MAX_WORD_LENGTH]
+
+
+def index_name(spec):
+    """Returns the name of the stored search index for the build."""
+    return '%s/search/%s/%s/%s.json.gz' % (
+        settings.ARTIFACTS_PREFIX, spec['owner'], spec['name'], spec['build'])
+
+
+def build_index(local_base):
+    """Returns the inverted index of the HTML pages under local_base.
+
+    The index lists each page with its title and length in words, the terms
+    in sorted order, and for each term the pages it appears in with its
+    weight there. Words of the title weigh SEARCH_TITLE_WEIGHT times more
+    than words of the text.
+    """
+    docs = []
+    postings = {}
+    for root, dirs, names in os.walk(local_base):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, local_base)
+            if not name.endswith('.html') or relpath in SKIPPED_PAGES:
+                continue
+            extractor = TextExtractor()
+            with open(path, 'rb') as fp:
+                try:
+                    extractor.feed(fp.read().decode('utf-8', 'replace'))
+                    extractor.close()
+                except HTMLParser.HTMLParseError:
+                    continue
+            title = ' '.join(''.join(extractor.title).split())
+            weights = {}
+            for word in tokenize(title):
+                weights[word] = (weights.get(word, 0) +
+                                 settings.SEARCH_TITLE_WEIGHT)
+            words = tokenize(' '.join(extractor.text))
+            for word in words:
+                weights[word] = weights.get(word, 0) + 1
+            doc = len(docs)
+            docs.append([relpath, title, len(words)])
+            for word, weight in weights.iteritems():
+                postings.setdefault(word, []).append([doc, weight])
+    terms = sorted(postings)
+    return {
+        'docs': docs,
+        'terms': terms,
+        'postings': [postings[term] for term in terms],
+    }
+
+
+def expand(index, word):
+    """Returns the positions of the terms matched by a word of a query.
+
+    A word ending with an asterisk matches the terms it is a prefix of, and
+    any other word matches the same term only.
+    """
+    terms = index['terms']
+    if word.endswith('*'):
+        prefix = word.rstrip('*')
+        start = bisect.bisect_left(terms, prefix)
+        end = start
+        while (end < len(terms) and terms[end].startswith(prefix) and
+               end - start < settings.SEARCH_MAX_EXPANSIONS):
+            end += 1
+        return range(start, end)
+    position = bisect.bisect_left(terms, word)
+    if position < len(terms) and terms[position] == word:
+        return [position]
+    return []
+
+
+def parse(text):
+    """Returns the lowercased words of a query, keeping trailing asterisks."""
+    return [word.lower() for word in re.findall(r'[\w*]+', text, re.UNICODE)
+            if word.strip('*')]
+
+
+def statistics(indexes, words):
+    """Returns the statistics of the indexes that BM25 scores words with.
+
+    These are the number of pages, their average length in words and the
+    number of pages each term matched by the words appears in, so that pages
+    of several indexes are scored as if they were in the same index.
+    """
+    count = 0
+    length = 0
+    frequencies = {}
+    for index in indexes:
+        count += len(index['docs'])
+        if 'length' in index:
+            length += index['length']
+        else:
+            length += sum(doc[2] for doc in index['docs'])
+        for word in words:
+            for position in expand(index, word):
+                term = index['terms'][position]
+                frequencies[term] = (frequencies.get(term, 0) +
+                                     len(index['postings'][position]))
+    return {
+        'count': count,
+        'average': float(length) / count if count else 1,
+        'frequencies': frequencies,
+    }
+
+
+def score(index, words, stats=None):
+    """Returns the scores of the pages of the index matching the words.
+
+    Pages must match every word, and are scored with BM25 on the weights of
+    the matched terms. The statistics are those of the index, unless given.
+    """
+    docs = index['docs']
+    if not words or not docs:
+        return {}
+    if stats is None:
+        stats = statistics([index], words)
+    count = stats['count']
+    average = stats['average'] or 1
+    scores = None
+    for word in words:
+        matched = {}
+        for position in expand(index, word):
+            postings = index['postings'][position]
+            frequency = stats['frequencies'][index['terms'][position]]
+            idf = math.log(1 + (count - frequency + 0.5) /
+                           (frequency + 0.5))
+            for doc, weight in postings:
+                norm = 0.25 + 0.75 * docs[doc][2] / average
+                matched[doc] = (matched.get(doc, 0) +
+                                idf * weight * 2.2 / (weight + 1.2 * norm))
+        if scores is None:
+            scores = matched
+        else:
+            scores = dict((doc, value + matched[doc])
+                          for doc, value in scores.iteritems()
+                          if doc in matched)
+        if not scores:
+            return {}
+    return scores
+
+
+def query(index, text, offset=0, limit=10):
+    """Returns the number of pages matching the query and a ranked slice."""
+    scores = score(index, parse(text))
+    docs = index['docs']
+    ranked = sorted(scores.iteritems(), key=lambda item: -item[1])
+    return len(ranked), [
+        {'path': docs[doc][0], 'title': docs[doc][1],
+         'score': round(value, 4)}
+        for doc, value in ranked[offset:offset + limit]]
+
+
+def shard_of(project_id):
+    """Returns the number of the global index shard for a project's docs.
+
+    Projects keep their shard when they are renamed or transferred.
+    """
+    return project_id % settings.SEARCH_SHARDS
+
+
+def shard_name(number):
+    """Returns a new name for a stored shard of the global index.
+
+    Each update of a shard is stored under a new name, since indexes are
+    kept in memory on the assumption that they never change once stored.
+    """
+    return '%s/search/shards/%s/%s.json.gz' % (
+        settings.ARTIFACTS_PREFIX, number, uuid.uuid4().hex)
+
+
+def merge_indexes(indexes):
+    """Returns one index of the pages of several projects.
+
+    The indexes are given as pairs of the project's full name and its index,
+    and each page of the merged index also lists the project it is from. The
+    total length of the pages is kept for scoring queries across indexes.
+    """
+    docs = []
+    postings = {}
+    for project, index in indexes:
+        start = len(docs)
+        docs.extend(doc + [project] for doc in index['docs'])
+        for term, entries in itertools.izip(index['terms'],
+                                            index['postings']):
+            postings.setdefault(term, []).extend(
+                [start + doc, weight] for doc, weight in entries)
+    terms = sorted(postings)
+    return {
+        'docs': docs,
+        'terms': terms,
+        'postings': [postings[term] for term in terms],
+        'length': sum(doc[2] for doc in docs),
+    }
+
+
+def split_index(index):
+    """Returns the index of each project's pages in a merged index.
+
+    This is the reverse of merge_indexes, so that the projects that have not
+    changed can be merged again without reading their own indexes.
+    """
+    indexes = {}
+    positions = []
+    for doc in index['docs']:
+        project = indexes.setdefault(
+            doc[3], {'docs': [], 'terms': [], 'postings': []})
+        positions.append(len(project['docs']))
+        project['docs'].append(doc[:3])
+    docs = index['docs']
+    for term, entries in itertools.izip(index['terms'], index['postings']):
+        for doc, weight in entries:
+            project = indexes[docs[doc][3]]
+            if not project['terms'] or project['terms'][-1] != term:
+                project['terms'].append(term)
+                project['postings'].append([])
+            project['postings'][-1].append([positions[doc], weight])
+    return indexes
+
+
+def query_shards(shards, text, project=None):
+    """Returns the pages of the shards matching the query, ranked.
+
+    The result counts the matching pages in total and in each project, and
+    lists the SEARCH_MAX_RANKED best pages with the project they are from.
+    Pages can be limited to those of one project. Pages are scored with the
+    statistics of all the shards, so that the scores of pages from different
+    shards are comparable.
+    """
+    words = parse(text)
+    stats = statistics(shards, words)
+    total = 0
+    facets = {}
+    ranked = []
+    for index in shards:
+        docs = index['docs']
+        for doc, value in score(index, words, stats).iteritems():
+            if project and docs[doc][3] != project:
+                continue
+            total += 1
+            facets[docs[doc][3]] = facets.get(docs[doc][3], 0) + 1
+            ranked.append((value, docs[doc]))
+    ranked = heapq.nlargest(settings.SEARCH_MAX_RANKED, ranked,
+                            key=lambda item: item[0])
+    return {
+        'total': total,
+        'facets': sorted(facets.iteritems(), key=lambda item: -item[1]),
+        'results': [
+            {'project': doc[3], 'path': doc[0], 'title': doc[1],
+             'score': round(value, 4)}
+            for value, doc in ranked],
+    }
@@ -9,6 +9,13 @@ urlpatterns = patterns(
     # Project page
     url(r'^(?P<project>[\w\.-]+)/$', ProjectDocs.as_view(),
         name='project_docs'),
+    # Full-text search of the project's docs
+    url(r'^(?P<project>[\w\.-]+)/_search/$', 'hasdocs.core.views.search_docs',
+        {'path': ''}, name='search_docs'),
+    # Docs bundled for reading offline
+    url(r'^(?P<project>[\w\.-]+)/_offline/$',
+        'hasdocs.core.views.download_docs', {'path': ''},
+        name='download_docs'),
     # Static documentation files
     url(r'^(?P<project>[\w\.-]+)/(?P<path>.*)$', 'hasdocs.core.views.serve',
         name='serve'),
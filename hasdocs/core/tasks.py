@@ -1,9 +1,22 @@
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
 import os
+import select
 import shutil
+import signal
 import subprocess
 import tarfile
+import tempfile
+import time
+import zipfile
 
+from boto.exception import BotoServerError
 import celery
+from celery.exceptions import Ignore
+from celery.task import periodic_task
 import pusher
 import requests
 from storages.backends.s3boto import S3BotoStorage
@@ -11,11 +24,22 @@ from storages.backends.s3boto import S3BotoStorage
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
 
-from hasdocs.projects.models import Build
+from hasdocs.core import archives, garbage, github, metrics, search
+from hasdocs.core.logs import BuildLog
+from hasdocs.projects.models import Build, Project, SearchShard
 
 logger = celery.utils.log.get_task_logger(__name__)
 
+# Errors after which a stage of a build is retried, if they are not errors
+# of the request itself
+TRANSIENT_ERRORS = (IOError, requests.ConnectionError, requests.Timeout,
+                    requests.HTTPError, BotoServerError)
+
 docs_storage = S3BotoStorage(
     bucket=settings.AWS_DOCS_BUCKET_NAME, acl='private',
     reduced_redundancy=True, secure_urls=False
@@ -27,144 +51,762 @@ pusher = pusher.Pusher(
 )
 
 
-def update_docs(project):
-    """Fetches the source repo, builds docs and uploads them for serving."""
-    build = Build.objects.create(project=project, status=Build.UNKNOWN)
-    logger.info('Build %s started' % build)
-    celery.chain(
-        fetch_source.s(build, project),
-        extract.s(project),
-        build_docs.s(project),
-        upload_docs.s(project)
-    ).apply_async()
+def update_docs(project, priority=Build.WEBHOOK):
+    """Queues a build of the docs for the project and returns it.
+
+    The build fetches the source repo, builds docs and uploads them for
+    serving once schedule_builds dispatches it.
+
+    If a build is already queued for the project, it is returned instead of
+    queueing another one, as it has yet to fetch the source. Builds that are
+    running are superseded by the new build and will not be uploaded.
+    """
+    with transaction.commit_on_success():
+        # Locks the project so that triggers for it are handled one by one
+        Project.objects.select_for_update().get(pk=project.pk)
+        try:
+            build = Build.objects.defer('output').filter(
+                project=project, status=Build.QUEUED)[0:1].get()
+            logger.info('Build %s is already queued' % build)
+            Build.objects.filter(pk=build.pk, priority__gt=priority).update(
+                priority=priority)
+            return build
+        except Build.DoesNotExist:
+            pass
+        Build.objects.filter(project=project, status=Build.BUILDING).update(
+            status=Build.SUPERSEDED)
+        build = Build.objects.create(project=project, status=Build.QUEUED,
+                                     priority=priority)
+    logger.info('Build %s queued' % build)
+    schedule_builds.delay()
     return build
 
 
-@celery.task
-def fetch_source(build, project):
-    """Fetchs the source from a GitHub repository."""
-    logger.info('Fetching source for %s from GitHub' % project)
-    if project.owner.is_organization():
-        access_token = project.owner.organization.team_set.get(
+def build_spec(build):
+    """Returns what the tasks of the build need to know about it.
+
+    The spec is passed from task to task instead of the build and project
+    instances, and each task returns a copy with what it adds to the spec.
+    """
+    project = build.project
+    return {
+        'build': build.pk,
+        'number': build.number,
+        'project': project.pk,
+        'owner': project.owner.login,
+        'name': project.name,
+        'generator': project.generator.name,
+        'docs_path': project.docs_path,
+        'requirements_path': project.requirements_path,
+        'fingerprint': project.fingerprint(),
+        'offline_format': project.offline_format,
+    }
+
+
+def dispatch_build(build):
+    """Sends the chain of tasks for the build to the workers."""
+    logger.info('Build %s started' % build)
+    spec = build_spec(build)
+    tasks = [fetch_source.s(spec), extract.s()]
+    if spec['generator'] == 'Sphinx':
+        # Then reuses the virtualenv built for the same requirements, if any,
+        # and the Sphinx environment of the previous build
+        tasks += [fetch_virtualenv.s(), fetch_sphinx_env.s(), build_docs.s(),
+                  index_docs.s(), bundle_docs.s(), store_sphinx_env.s(),
+                  store_virtualenv.s()]
+    else:
+        tasks += [build_docs.s(), index_docs.s(), bundle_docs.s()]
+    tasks += [upload_docs.s()]
+    celery.chain(*tasks).apply_async()
+
+
+def target_dir(spec):
+    """Returns the local directory the docs for the build are built into."""
+    target = subprocess.check_output([
+        'bash', 'bin/target_%s' % spec['generator'].lower(),
+        spec['path'], spec['docs_path']])
+    return os.path.normpath(os.path.join(spec['path'], target.rstrip()))
+
+
+def source_manifest(spec, exclude):
+    """Returns the hash and modification time of each file in the checkout.
+
+    Files under the exclude directory are left out.
+    """
+    files = {}
+    for root, dirs, names in os.walk(spec['path']):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != exclude]
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                continue
+            with open(path, 'rb') as fp:
+                digest = hashlib.sha1(fp.read()).hexdigest()
+            files[os.path.relpath(path, spec['path'])] = [
+                digest, os.path.getmtime(path)]
+    return files
+
+
+@periodic_task(run_every=datetime.timedelta(minutes=1))
+def schedule_builds():
+    """Dispatches queued builds while there is capacity for them.
+
+    Only one run dispatches builds at a time, under a lock in the cache, as
+    runs would otherwise count the same running builds and exceed the limits.
+    A run that finds the lock taken asks the run holding it to run again
+    once it is done, so that the capacity freed meanwhile is used.
+    """
+    # Set before taking the lock, so that the run holding it sees it
+    cache.set('schedule-builds:pending', True,
+              settings.BUILD_SCHEDULER_LOCK_TIMEOUT)
+    while cache.add('schedule-builds:lock', True,
+                    settings.BUILD_SCHEDULER_LOCK_TIMEOUT):
+        try:
+            cache.delete('schedule-builds:pending')
+            dispatch_builds()
+        finally:
+            cache.delete('schedule-builds:lock')
+        if not cache.get('schedule-builds:pending'):
+            break
+
+
+def dispatch_builds():
+    """Dispatches queued builds while there is capacity for them.
+
+    Queued builds are taken by priority and then by the time they were
+    queued, skipping the builds of owners that already have as many builds
+    running as their plan allows. Superseded builds count as running until
+    their chain finishes, as they hold a worker until then.
+    """
+    now = timezone.now()
+    running = Build.objects.filter(dispatched_at__isnull=False,
+                                   finished_at__isnull=True)
+    # Fails the builds that have been running for too long
+    expired = running.filter(
+        dispatched_at__lt=now - datetime.timedelta(
+            seconds=settings.BUILD_TIMEOUT))
+    if expired.filter(status__in=[Build.QUEUED, Build.BUILDING]).update(
+            status=Build.FAILURE, finished_at=now):
+        logger.warning('Failed builds that have timed out')
+    expired.update(finished_at=now)
+    capacity = settings.BUILD_CONCURRENCY - running.count()
+    queued = Build.objects.defer('output').select_related(
+        'project__owner__plan', 'project__generator'
+    ).filter(status=Build.QUEUED, dispatched_at__isnull=True).order_by(
+        'priority', 'started_at')
+    metrics.record('Builds/Queued', queued.count())
+    if capacity <= 0:
+        return
+    owners = dict(running.order_by().values_list('project__owner').annotate(
+        Count('id')))
+    for build in queued[:settings.BUILD_SCHEDULER_SCAN]:
+        owner = build.project.owner
+        if owner.plan:
+            limit = owner.plan.concurrent_builds
+        else:
+            limit = settings.BUILD_OWNER_CONCURRENCY
+        if owners.get(owner.pk, 0) >= limit:
+            continue
+        # Claims the build so that it is dispatched only once
+        if not Build.objects.filter(
+            pk=build.pk, dispatched_at__isnull=True
+        ).update(dispatched_at=now):
+            continue
+        wait = (now - build.started_at).total_seconds()
+        metrics.record('Builds/QueueWait', wait)
+        metrics.record('Builds/QueueWait/%s' % build.get_priority_display(),
+                       wait)
+        dispatch_build(build)
+        owners[owner.pk] = owners.get(owner.pk, 0) + 1
+        capacity -= 1
+        if not capacity:
+            break
+
+
+def is_transient(exc):
+    """Returns whether a stage that failed with the error may succeed later.
+
+    Connection errors, timeouts and server errors are transient, but client
+    errors such as a missing or empty repo are not.
+    """
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code >= 500
+    if isinstance(exc, BotoServerError):
+        return exc.status >= 500
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+class BuildTask(celery.Task):
+    """Base class for the tasks in the chain of a build.
+
+    Each task takes the spec of the build as its first argument, and the
+    spec it returns is stored on the build with the name of the task, which
+    shows how far the build got. A task that fails on a transient error is
+    retried with exponential backoff, running again with the same spec on
+    the same checkout before the rest of the chain. Restarting a build
+    queues a new build from the start, as the checkout of a build is only
+    on the worker it ran on.
+    """
+    abstract = True
+    max_retries = settings.BUILD_STAGE_RETRIES
+
+    def __call__(self, spec, *args, **kwargs):
+        """Runs the task, recording the time and resources it uses."""
+        usage = metrics.StageUsage(self.name.rsplit('.', 1)[-1])
+        try:
+            with usage:
+                result = super(BuildTask, self).__call__(
+                    spec, *args, **kwargs)
+        except Exception as exc:
+            if not is_transient(exc):
+                raise
+            logger.warning('Stage %s of build %s failed: %s' % (
+                usage.name, spec['build'], exc))
+            metrics.record('Builds/Stages/%s/Retries' % usage.name, 1)
+            if isinstance(exc, github.RateLimited):
+                countdown = github.retry_delay(exc, self.request.retries)
+            else:
+                countdown = (settings.BUILD_RETRY_DELAY *
+                             2 ** self.request.retries)
+            raise self.retry(exc=exc, countdown=countdown)
+        finally:
+            Build.objects.record_stage(spec['build'], usage.stats())
+        if result is not None:
+            Build.objects.filter(pk=spec['build']).update(
+                checkpoint=usage.name, spec=json.dumps(result))
+        return result
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        """Marks the build as failed and dispatches the next queued build."""
+        spec = args[0]
+        Build.objects.filter(
+            pk=spec['build'], status__in=[Build.QUEUED, Build.BUILDING]
+        ).update(status=Build.FAILURE, finished_at=timezone.now())
+        # Superseded builds stay superseded, but are no longer running
+        Build.objects.filter(
+            pk=spec['build'], finished_at__isnull=True
+        ).update(finished_at=timezone.now())
+        # Removes what is left of the build on this worker
+        if spec.get('previous_path') and os.path.islink(spec['previous_path']):
+            os.remove(spec['previous_path'])
+        if spec.get('path'):
+            shutil.rmtree(spec['path'], ignore_errors=True)
+        if spec.get('filename') and os.path.exists(spec['filename']):
+            os.remove(spec['filename'])
+        schedule_builds.delay()
+
+
+def python_version():
+    """Returns the version of the Python used for building virtualenvs."""
+    return subprocess.check_output([settings.VENV_PYTHON, '-V'],
+                                   stderr=subprocess.STDOUT)
+
+
+def virtualenv_key(spec):
+    """Returns the key identifying the virtualenv for the build.
+
+    The key is the hash of the owner, the Python version, the build script
+    and the requirements file, or the setup.py when no requirements file is
+    given. Virtualenvs are not shared between owners, since the build of a
+    project may change the virtualenv it runs in.
+    """
+    digest = hashlib.sha1(python_version())
+    digest.update(spec['owner'].encode('utf-8'))
+    with open('bin/build_sphinx', 'rb') as fp:
+        digest.update(fp.read())
+    if spec['requirements_path']:
+        path = os.path.join(spec['path'], spec['requirements_path'])
+    else:
+        # Then the project itself is installed with its dependencies
+        digest.update('%s/%s' % (spec['owner'], spec['name']))
+        path = os.path.join(spec['path'], 'setup.py')
+    try:
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    except IOError:
+        logger.warning('Failed to read %s' % path)
+    return digest.hexdigest()
+
+
+def latest_commit(spec, payload):
+    """Returns the SHA of the head of the default branch of the project."""
+    r = github.request('GET', '/repos/%s/%s/commits' % (
+        spec['owner'], spec['name']), params=dict(payload, per_page=1))
+    r.raise_for_status()
+    return r.json()[0]['sha']
+
+
+def prune_builds():
+    """Removes the files that builds left on this worker.
+
+    Checkouts, tarballs and links under BUILD_ROOT that are older than
+    BUILD_TIMEOUT belong to builds that timed out or whose worker died.
+    """
+    cutoff = time.time() - settings.BUILD_TIMEOUT
+    for name in os.listdir(settings.BUILD_ROOT):
+        path = os.path.join(settings.BUILD_ROOT, name)
+        if os.lstat(path).st_mtime > cutoff:
+            continue
+        logger.info('Removing abandoned build files %s' % name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                # Then another build removed it first
+                pass
+
+
+@celery.task(base=BuildTask)
+def fetch_source(spec):
+    """Fetchs the source from a GitHub repository.
+
+    The build is skipped when the published docs were built from the same
+    commit with the same settings, and marked as unchanged rather than as a
+    success, since it uploads nothing.
+    """
+    logger.info('Fetching source for %(owner)s/%(name)s from GitHub' % spec)
+    Build.objects.filter(pk=spec['build'], status=Build.QUEUED).update(
+        status=Build.BUILDING)
+    owner = Project.objects.select_related('owner').get(
+        pk=spec['project']).owner
+    if owner.is_organization():
+        access_token = owner.organization.team_set.get(
             name='Owners'
         ).members.exclude(github_access_token='')[0].github_access_token
     else:
-        access_token = project.owner.user.github_access_token
+        access_token = owner.user.github_access_token
     payload = {'access_token': access_token}
-    r = requests.get('%s/repos/%s/%s/tarball' % (
-        settings.GITHUB_API_URL, project.owner, project.name,
-    ), params=payload)
-    build.filename = '%s.tar.gz' % project
-    with open(build.filename, 'wb') as file:
+    commit = latest_commit(spec, payload)
+    Build.objects.filter(pk=spec['build']).update(
+        commit=commit, fingerprint=spec['fingerprint'])
+    if Build.objects.published_source(spec['project']) == (
+            commit, spec['fingerprint']):
+        logger.info('Skipped build %s of unchanged commit %s' % (
+            spec['build'], commit))
+        Build.objects.filter(
+            pk=spec['build'], status=Build.BUILDING
+        ).update(status=Build.UNCHANGED, finished_at=timezone.now(),
+                 output='The published docs are already built from %s.\n' % (
+                     commit))
+        # Superseded builds stay superseded, but are no longer running
+        Build.objects.filter(
+            pk=spec['build'], finished_at__isnull=True
+        ).update(finished_at=timezone.now())
+        metrics.record('Builds/Unchanged', 1)
+        schedule_builds.delay()
+        # Then the rest of the chain is not run
+        raise Ignore()
+    r = github.request('GET', '/repos/%s/%s/tarball/%s' % (
+        spec['owner'], spec['name'], commit), params=payload)
+    r.raise_for_status()
+    if not os.path.isdir(settings.BUILD_ROOT):
+        os.makedirs(settings.BUILD_ROOT)
+    prune_builds()
+    filename = os.path.join(settings.BUILD_ROOT,
+                            '%(owner)s-%(name)s-%(build)s.tar.gz' % spec)
+    with open(filename, 'wb') as file:
         file.write(r.content)
-    return build
+    metrics.current_stage().bytes += len(r.content)
+    return dict(spec, commit=commit, filename=filename)
+
 
+@celery.task(base=BuildTask)
+def extract(spec):
+    """Extracts the given tarball into a directory of the build's own.
 
-@celery.task
-def extract(build, project):
-    """Extracts the given tarball and returns its resulting path."""
-    logger.debug('Extracting %s', build.filename)
+    GitHub names the top directory of the tarball after the commit, so it is
+    left out and the files are extracted into a new directory under
+    BUILD_ROOT instead, as builds of the same commit would otherwise share it.
+    """
+    logger.debug('Extracting %s', spec['filename'])
     try:
-        with tarfile.open(build.filename) as tar:
-            build.path = tar.next().path
-            tar.extractall()
-        return build
+        with tarfile.open(spec['filename']) as tar:
+            prefix = tar.next().path + '/'
+            members = []
+            for member in tar.getmembers():
+                if not member.path.startswith(prefix):
+                    continue
+                member.path = member.path[len(prefix):]
+                if member.islnk():
+                    member.linkname = member.linkname[len(prefix):]
+                members.append(member)
+            path = tempfile.mkdtemp(prefix='build-%s-' % spec['build'],
+                                    dir=settings.BUILD_ROOT)
+            tar.extractall(path, members)
+            metrics.current_stage().files += len(members)
     except tarfile.ReadError:
-        logger.warning('Error opening file %s' % build.filename)
+        logger.warning('Error opening file %s' % spec['filename'])
+        os.remove(spec['filename'])
         raise
-    finally:
-        os.remove(build.filename)
+    # Keeps the tarball until then for the retries of this stage
+    os.remove(spec['filename'])
+    return dict(spec, path=path)
+
 
+def prune_virtualenvs():
+    """Removes the virtualenvs on this worker unused for VENV_LOCAL_AGE.
 
-@celery.task
-def fetch_virtualenv(build, project):
-    """etrives the virtualenv for the project from S3, if any."""
-    logger.info('Fetching virtualenv for %s/%s' % (
-        project.owner, project.name))
-    source = '%s/%s/%s' % (project.owner, project.name, settings.VENV_FILENAME)
+    Virtualenvs that a build is creating, updating or building docs with
+    under their lock are kept. Lock files are kept too, as a build may be
+    waiting on them.
+    """
+    if not os.path.isdir(settings.VENV_ROOT):
+        return
+    cutoff = time.time() - settings.VENV_LOCAL_AGE
+    for name in os.listdir(settings.VENV_ROOT):
+        path = os.path.join(settings.VENV_ROOT, name)
+        if name.endswith('.lock') or os.path.getmtime(path) > cutoff:
+            continue
+        with open(path + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Then a build is using the virtualenv
+                continue
+            logger.info('Removing unused virtualenv %s' % name)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@celery.task(base=BuildTask)
+def fetch_virtualenv(spec):
+    """Retrieves the virtualenv for the build's requirements, if any."""
+    prune_virtualenvs()
+    key = virtualenv_key(spec)
+    venv = os.path.join(settings.VENV_ROOT, key)
+    source = '%s/venvs/%s.tar.gz' % (settings.ARTIFACTS_PREFIX, key)
+    cached = os.path.exists(os.path.join(venv, settings.VENV_MARKER))
+    if cached:
+        logger.info('Found virtualenv %s on this worker' % key)
+    elif docs_storage.exists(source):
+        logger.info('Fetching virtualenv %s' % key)
+        if not os.path.isdir(settings.VENV_ROOT):
+            os.makedirs(settings.VENV_ROOT)
+        staging = tempfile.mkdtemp(dir=settings.VENV_ROOT)
+        try:
+            with docs_storage.open(source, 'rb') as fp:
+                with tarfile.open(fileobj=fp) as tar:
+                    tar.extractall(staging)
+                metrics.current_stage().bytes += fp.size
+            # Moves the virtualenv in place only once it is complete, under
+            # the lock bin/build_sphinx holds while it builds virtualenvs
+            with open(venv + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(
+                        os.path.join(venv, settings.VENV_MARKER)):
+                    shutil.rmtree(venv, ignore_errors=True)
+                    os.rename(os.path.join(staging, key), venv)
+        finally:
+            shutil.rmtree(staging)
+        cached = True
+    else:
+        logger.info('No stored virtualenv was found for %s' % key)
+    if cached:
+        # Marks the virtualenv as used, so that it is not pruned
+        os.utime(venv, None)
+    return dict(spec, venv_key=key, venv_cached=cached)
+
+
+def wheel_dir(spec):
+    """Returns the local directory of the wheels built for the owner.
+
+    Wheels are not shared between owners, since a requirement from version
+    control or a URL may be built into a wheel under any package's name.
+    Directories of the other owners that are unused for WHEEL_LOCAL_AGE
+    seconds are removed.
+    """
+    path = os.path.join(settings.WHEEL_DIR, spec['owner'])
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    # Marks the directory as used, so that it is not removed
+    os.utime(path, None)
+    cutoff = time.time() - settings.WHEEL_LOCAL_AGE
+    for name in os.listdir(settings.WHEEL_DIR):
+        other = os.path.join(settings.WHEEL_DIR, name)
+        if other != path and os.path.getmtime(other) < cutoff:
+            logger.info('Removing unused wheels of %s' % name)
+            shutil.rmtree(other, ignore_errors=True)
+    return path
+
+
+def kill(proc):
+    """Kills the process and the processes it started."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # Then the process group has already exited
+        pass
+
+
+@celery.task(base=BuildTask)
+def fetch_sphinx_env(spec):
+    """Restores the Sphinx environment and output of the previous build.
+
+    Files that are unchanged since the previous build get back the
+    modification times Sphinx saw then, and changed files are marked as
+    modified now, so that Sphinx only reads and writes the changed documents.
+    """
+    source = '%s/sphinx/%s/%s.tar.gz' % (settings.ARTIFACTS_PREFIX,
+                                         spec['owner'], spec['name'])
+    if not docs_storage.exists(source):
+        logger.info('No stored Sphinx environment was found for '
+                    '%(owner)s/%(name)s' % spec)
+        return spec
+    logger.info('Fetching Sphinx environment for %(owner)s/%(name)s' % spec)
+    build_dir = os.path.dirname(target_dir(spec))
+    files = source_manifest(spec, build_dir)
+    with docs_storage.open(source, 'rb') as fp:
+        with tarfile.open(fileobj=fp) as tar:
+            tar.extractall(spec['path'])
+        metrics.current_stage().bytes += fp.size
     try:
-        with docs_storage.open(source, 'r') as fp:
-            with tarfile.open(fileobj=fp) as tar:
-                tar.extractall()
-            logger.info('Fetched previously stored virtualenv')
+        with open(os.path.join(build_dir, settings.SPHINX_MANIFEST)) as fp:
+            manifest = json.load(fp)
     except IOError:
-        logger.info('No previously stored virtualenv was found')
-    finally:
-        return build
+        logger.warning('Stored Sphinx environment has no manifest')
+        return spec
+    now = time.time()
+    for name, (digest, mtime) in files.iteritems():
+        previous = manifest['files'].get(name)
+        if previous and previous[0] == digest:
+            mtime = previous[1]
+        else:
+            mtime = now
+        os.utime(os.path.join(spec['path'], name), (mtime, mtime))
+    # Points the checkout path of the previous build to this checkout, as
+    # dependencies such as the modules read by autodoc are recorded by path
+    previous_path = os.path.abspath(manifest['path'])
+    path = os.path.abspath(spec['path'])
+    if os.path.islink(previous_path) and os.readlink(previous_path) == path:
+        # Then the link was made by an earlier attempt of this stage
+        return dict(spec, previous_path=previous_path)
+    if not os.path.exists(previous_path):
+        os.symlink(path, previous_path)
+        return dict(spec, previous_path=previous_path)
+    return spec
 
 
-@celery.task
-def build_docs(build, project):
+@celery.task(base=BuildTask)
+def build_docs(spec):
     """Builds the documentations for the projects."""
-    logger.info('Building documentation for %s/%s' % (
-        project.owner, project.name))
+    if Build.objects.is_superseded(spec['build']):
+        logger.info('Skipped building superseded build %s' % spec['build'])
+        return spec
+    logger.info('Building documentation for %(owner)s/%(name)s' % spec)
     args = ['bash']
-    if project.generator.name == 'Sphinx':
-        args += ['bin/build_sphinx', build.path, project.docs_path,
-                 project.requirements_path]
-    elif project.generator.name == 'Jekyll':
-        args += ['bin/build_jekyll', build.path, project.docs_path]
+    if spec['generator'] == 'Sphinx':
+        args += ['bin/build_sphinx', spec['path'], spec['docs_path'],
+                 spec['requirements_path'],
+                 os.path.join(settings.VENV_ROOT, spec['venv_key'])]
+    elif spec['generator'] == 'Jekyll':
+        args += ['bin/build_jekyll', spec['path'], spec['docs_path']]
+    log = BuildLog(spec['build'], pusher['build-%s' % spec['build']])
     try:
-        proc = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            universal_newlines=True)
-        # Poll until the process terminates
-        while proc.poll() is None:
-            line = proc.stdout.readline()
-            if line:
-                build.output += line
-                channel = 'build-%s' % build.pk
-                pusher[channel].trigger('log', {'message': line})
-        build.save()
-        logger.info('Built docs for %s/%s' % (project.owner, project.name))
-        return build
-    except subprocess.CalledProcessError, e:
-        logger.warning('Build failed for %s/%s' % (
-            project.owner, project.name))
-        build.output = e.output
-        build.status = Build.FAILURE
-        build.save()
+        env = dict(os.environ, WHEEL_DIR=wheel_dir(spec),
+                   PACKAGE_INDEX_DIR=settings.PACKAGE_INDEX_DIR)
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env,
+                                preexec_fn=os.setsid)
+        fd = proc.stdout.fileno()
+        checked_at = time.time()
+        superseded = False
+        try:
+            # Reads the output as it comes, flushing it to the log in batches
+            while True:
+                ready, _, _ = select.select([fd], [], [], log.timeout())
+                if ready:
+                    data = os.read(fd, 64 * 1024)
+                    if not data:
+                        break
+                    log.write(data)
+                log.flush_if_due()
+                if (time.time() - checked_at >=
+                        settings.BUILD_SUPERSEDED_INTERVAL):
+                    checked_at = time.time()
+                    if Build.objects.is_superseded(spec['build']):
+                        # Then the docs would not be uploaded, so the build
+                        # is stopped rather than left to hold the worker
+                        superseded = True
+                        kill(proc)
+                        break
+            log.close()
+        except Exception:
+            # Then the generator is stopped, as the stage may be retried
+            kill(proc)
+            proc.wait()
+            raise
+        # Waits for the generator, accounting for the resources it used
+        _, status, rusage = os.wait4(proc.pid, 0)
+        metrics.current_stage().add_child(rusage)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        if superseded:
+            logger.info('Stopped superseded build %s' % spec['build'])
+            return spec
+        if proc.returncode:
+            raise subprocess.CalledProcessError(
+                proc.returncode, args, output=log.tail())
+        logger.info('Built docs for %(owner)s/%(name)s' % spec)
+        return spec
+    except subprocess.CalledProcessError:
+        logger.warning('Build failed for %(owner)s/%(name)s' % spec)
+        Build.objects.filter(pk=spec['build']).update(
+            status=Build.FAILURE, finished_at=timezone.now())
         # TODO: nicer cleanup of mess on failure (maybe an error link)
-        shutil.rmtree(build.path)
+        shutil.rmtree(spec['path'])
         # TODO: nicer handling of exception
         raise
 
 
-@celery.task
-def store_virtualenv(build, project):
-    """Stores the virtualenv in S3 for future builds."""
-    logger.info('Storing virtualenv for %s/%s' % (project.owner, project.name))
-    venv = '%s/%s' % (build.path, settings.VENV_FILENAME)
-    dest = '%s/%s/%s' % (project.owner, project.name, settings.VENV_FILENAME)
-    with tarfile.open(venv, 'w:gz') as tar:
-        tar.add('%s/%s' % (build.path, settings.VENV_NAME))
-    with open(venv, 'rb') as fp:
-        file = File(fp)
-        docs_storage.save(dest, file)
-    os.remove(venv)
-    logger.info('Stored virtualenv for %s/%s' % (project.owner, project.name))
-    return build
+@celery.task(base=BuildTask)
+def index_docs(spec):
+    """Stores the full-text search index of the built docs."""
+    if Build.objects.is_superseded(spec['build']):
+        return spec
+    logger.info('Indexing docs for %(owner)s/%(name)s' % spec)
+    index = search.build_index(target_dir(spec))
+    name = search.index_name(spec)
+    data = archives.dump_index(index)
+    docs_storage.save(name, ContentFile(data))
+    usage = metrics.current_stage()
+    usage.files += len(index['docs'])
+    usage.bytes += len(data)
+    return dict(spec, search_index=name)
 
 
-@celery.task
-def upload_docs(build, project):
-    """Uploads the built docs to the appropriate storage."""
-    project = build.project
-    logger.info('Uploading docs for %s' % project)
-    count = 0
-    dest_base = '%s/%s' % (project.owner, project.name)
-    if project.generator.name == 'Sphinx':
-        target = subprocess.check_output(
-            ['bash', 'bin/target_sphinx', build.path, project.docs_path])
-    elif project.generator.name == 'Jekyll':
-        target = subprocess.check_output(
-            ['bash', 'bin/target_jekyll', build.path, project.docs_path])
-    local_base = '%s/%s/' % (build.path, target.rstrip())
+def offline_name(spec, extension):
+    """Returns the name of the stored offline docs for the build."""
+    return '%s/offline/%s/%s/%s/%s.%s' % (
+        settings.ARTIFACTS_PREFIX, spec['owner'], spec['name'], spec['build'],
+        spec['name'], extension)
+
+
+@celery.task(base=BuildTask)
+def bundle_docs(spec):
+    """Stores the docs in the project's offline format, if any.
+
+    HTML is bundled from the built docs, and the other formats are built by
+    Sphinx from the environment of the html docs. Failing to build them
+    leaves the build without offline docs rather than failing it.
+    """
+    offline_format = spec.get('offline_format')
+    if not offline_format or Build.objects.is_superseded(spec['build']):
+        return spec
+    html_dir = target_dir(spec)
+    if offline_format == 'html':
+        output_dir = html_dir
+    elif spec['generator'] == 'Sphinx':
+        logger.info('Building %s docs for %s/%s' % (
+            offline_format, spec['owner'], spec['name']))
+        output_dir = os.path.join(os.path.dirname(html_dir), offline_format)
+        try:
+            subprocess.check_output([
+                'bash', 'bin/bundle_sphinx', spec['path'], spec['docs_path'],
+                os.path.join(settings.VENV_ROOT, spec['venv_key']),
+                offline_format], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logger.warning('Failed to build %s docs: %s' % (
+                offline_format, e.output[-settings.BUILD_LOG_TAIL_SIZE:]))
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return spec
+    else:
+        logger.warning('No %s docs for %s' % (
+            offline_format, spec['generator']))
+        return spec
+    if offline_format == 'epub':
+        filenames = glob.glob(os.path.join(output_dir, '*.epub'))
+        if not filenames:
+            logger.warning('No epub was built for %s/%s' % (
+                spec['owner'], spec['name']))
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return spec
+        filename = filenames[0]
+        name = offline_name(spec, 'epub')
+    else:
+        filename = '%s.offline.zip' % spec['build']
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            for root, dirs, names in os.walk(output_dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    bundle.write(path, os.path.join(
+                        spec['name'], os.path.relpath(path, output_dir)))
+        name = offline_name(spec, 'zip')
+    with open(filename, 'rb') as fp:
+        docs_storage.save(name, File(fp))
+    metrics.current_stage().bytes += os.path.getsize(filename)
+    if name.endswith('.zip'):
+        os.remove(filename)
+    if output_dir != html_dir:
+        # Then the output is not kept in the Sphinx environment
+        shutil.rmtree(output_dir)
+    return dict(spec, offline_bundle=name)
+
+
+@celery.task(base=BuildTask)
+def store_sphinx_env(spec):
+    """Stores the Sphinx environment and output for the following builds."""
+    # The link is already gone when this stage is retried
+    if spec.get('previous_path') and os.path.islink(spec['previous_path']):
+        os.remove(spec['previous_path'])
+    if Build.objects.is_superseded(spec['build']):
+        return spec
+    build_dir = os.path.dirname(target_dir(spec))
+    if not os.path.isdir(build_dir):
+        return spec
+    logger.info('Storing Sphinx environment for %(owner)s/%(name)s' % spec)
+    manifest = {'path': spec['path'],
+                'files': source_manifest(spec, build_dir)}
+    with open(os.path.join(build_dir, settings.SPHINX_MANIFEST), 'w') as fp:
+        json.dump(manifest, fp)
+    filename = '%s.sphinx.tar.gz' % spec['build']
+    with tarfile.open(filename, 'w:gz') as tar:
+        tar.add(build_dir, arcname=os.path.relpath(build_dir, spec['path']))
+    dest = '%s/sphinx/%s/%s.tar.gz' % (settings.ARTIFACTS_PREFIX,
+                                       spec['owner'], spec['name'])
+    with open(filename, 'rb') as fp:
+        docs_storage.save(dest, File(fp))
+    metrics.current_stage().bytes += os.path.getsize(filename)
+    os.remove(filename)
+    return spec
+
+
+@celery.task(base=BuildTask)
+def store_virtualenv(spec):
+    """Stores a newly built virtualenv in S3 for future builds."""
+    key = spec['venv_key']
+    venv = os.path.join(settings.VENV_ROOT, key)
+    dest = '%s/venvs/%s.tar.gz' % (settings.ARTIFACTS_PREFIX, key)
+    if (spec['venv_cached'] or
+            not os.path.exists(os.path.join(venv, settings.VENV_MARKER)) or
+            docs_storage.exists(dest)):
+        # Then there is no new virtualenv to be stored
+        return spec
+    logger.info('Storing virtualenv %s' % key)
+    filename = '%s.tar.gz' % key
+    with tarfile.open(filename, 'w:gz') as tar:
+        tar.add(venv, arcname=key)
+    with open(filename, 'rb') as fp:
+        docs_storage.save(dest, File(fp))
+    metrics.current_stage().bytes += os.path.getsize(filename)
+    os.remove(filename)
+    logger.info('Stored virtualenv %s' % key)
+    return spec
+
+
+def upload_files(spec, local_base):
+    """Uploads each of the built doc files to the storage."""
+    usage = metrics.current_stage()
+    dest_base = '%(owner)s/%(name)s' % spec
     # Walks through the built doc files and uploads them
     for root, dirs, names in os.walk(local_base):
-        for idx, name in enumerate(names):
+        for name in names:
             with open(os.path.join(root, name), 'rb') as fp:
                 file = File(fp)
+                usage.bytes += file.size
+                usage.files += 1
                 dest = '/%s/%s' % (dest_base,
                                    os.path.relpath(file.name, local_base))
                 logger.info('Uploading %s...' % dest)
@@ -174,10 +816,173 @@ def upload_docs(build, project):
                 # Deletes the file from local after uploading
                 file.close()
                 os.remove(os.path.join(root, name))
-        count += idx
-    shutil.rmtree(build.path)
-    # Updates the project's modified date
-    project.save()
-    build.status = Build.SUCCESS
-    build.save()
-    logger.info('Finished uploading %s files' % count)
+
+
+def upload_archive(spec, local_base):
+    """Uploads the built docs as one archive with its index.
+
+    The files shared with other projects are uploaded as blobs first, unless
+    they are stored already. Returns the name of the stored archive.
+    """
+    usage = metrics.current_stage()
+    archive = archives.archive_name(spec)
+    filename = '%s.tar' % spec['build']
+    index, blobs = archives.create_archive(local_base, filename)
+    usage.files += len(index)
+    usage.bytes += os.path.getsize(filename)
+    uploaded = 0
+    for digest, path in blobs.iteritems():
+        if archives.store_blob(docs_storage, digest, path):
+            usage.bytes += os.path.getsize(path)
+            uploaded += 1
+    metrics.record('Docs/Blobs/Uploaded', uploaded)
+    metrics.record('Docs/Blobs/Reused', len(blobs) - uploaded)
+    logger.info('Uploading %s...' % archive)
+    with open(filename, 'rb') as fp:
+        docs_storage.save(archive, File(fp))
+    os.remove(filename)
+    docs_storage.save(archives.index_name(archive),
+                      ContentFile(archives.dump_index(index)))
+    return archive
+
+
+@celery.task(base=BuildTask)
+def upload_docs(spec):
+    """Uploads the built docs to the appropriate storage."""
+    if Build.objects.is_superseded(spec['build']):
+        logger.info('Skipped uploading superseded build %s' % spec['build'])
+        shutil.rmtree(spec['path'])
+        Build.objects.filter(pk=spec['build']).update(
+            finished_at=timezone.now())
+        schedule_builds.delay()
+        return
+    logger.info('Uploading docs for %(owner)s/%(name)s' % spec)
+    local_base = target_dir(spec)
+    if settings.DOCS_PUBLISH_ARCHIVES:
+        archive = upload_archive(spec, local_base)
+    else:
+        upload_files(spec, local_base)
+        archive = ''
+    shutil.rmtree(spec['path'])
+    # Publishes the docs and updates the project's modified date. The files
+    # older than the dispatch of the build were not uploaded by it, even if
+    # this stage was retried.
+    published_at = Build.objects.filter(pk=spec['build']).values_list(
+        'dispatched_at', flat=True)[0]
+    Project.objects.filter(pk=spec['project']).update(
+        mod_date=timezone.now(), published_at=published_at,
+        docs_archive=archive, search_index=spec.get('search_index', ''),
+        search_shard=(search.shard_of(spec['project'])
+                      if spec.get('search_index') else None),
+        offline_bundle=spec.get('offline_bundle', ''))
+    Build.objects.filter(pk=spec['build']).update(
+        status=Build.SUCCESS, finished_at=timezone.now())
+    logger.info('Finished uploading %s files' % (
+        metrics.current_stage().files))
+    if spec.get('search_index'):
+        queue_search_shard(search.shard_of(spec['project']))
+    schedule_builds.delay()
+
+
+def queue_search_shard(number):
+    """Queues an update of the shard of the global index, unless queued.
+
+    The update waits SEARCH_SHARD_DELAY seconds, so that the builds finished
+    meanwhile are indexed together.
+    """
+    key = 'search-shard:%s' % number
+    if cache.add(key, True, settings.SEARCH_SHARD_DELAY):
+        update_search_shard.apply_async(
+            (number,), countdown=settings.SEARCH_SHARD_DELAY)
+
+
+def queue_search_shards(project_ids):
+    """Queues updates of the shards of the global index with projects' docs."""
+    for number in set(search.shard_of(pk) for pk in project_ids):
+        queue_search_shard(number)
+
+
+@celery.task(max_retries=settings.SEARCH_SHARD_RETRIES)
+def update_search_shard(number):
+    """Stores the shard of the global index with the public projects' docs.
+
+    The shard is updated from the one last published, which lists the search
+    index each project was merged from. Only the indexes of the projects
+    published since are read, and the projects that were made private,
+    renamed or deleted are dropped. The shard is published only if no other
+    update of it was published meanwhile.
+    """
+    cache.delete('search-shard:%s' % number)
+    shard, created = SearchShard.objects.get_or_create(number=number)
+    previous = {}
+    sources = {}
+    if shard.index:
+        try:
+            index = archives.load_index(docs_storage, shard.index,
+                                        archives.shards)
+            previous = search.split_index(index)
+            sources = index.get('sources', {})
+        except IOError:
+            logger.warning('Failed to read search shard %s' % number)
+    indexes = []
+    merged_sources = {}
+    read = 0
+    for owner, name, index in Project.objects.filter(
+        private=False, search_shard=number
+    ).exclude(search_index='').values_list(
+        'owner__login', 'name', 'search_index'
+    ):
+        project = '%s/%s' % (owner, name)
+        if sources.get(project) == index and project in previous:
+            # Then the project's docs are unchanged since the last update
+            indexes.append((project, previous[project]))
+        else:
+            try:
+                indexes.append((project,
+                                archives.load_index(docs_storage, index)))
+            except IOError:
+                logger.warning('Failed to read the search index of %s' % (
+                    project))
+                continue
+            read += 1
+        merged_sources[project] = index
+    merged = search.merge_indexes(indexes)
+    merged['sources'] = merged_sources
+    name = search.shard_name(number)
+    docs_storage.save(name, ContentFile(archives.dump_index(merged)))
+    if not SearchShard.objects.filter(
+        pk=shard.pk, index=shard.index
+    ).update(index=name, mod_date=timezone.now()):
+        # Then the shard may miss the docs the other update has published
+        docs_storage.delete(name)
+        raise update_search_shard.retry(
+            countdown=settings.SEARCH_SHARD_DELAY)
+    logger.info('Indexed %s pages of %s projects in search shard %s, '
+                'reading %s indexes' % (len(merged['docs']), len(indexes),
+                                        number, read))
+
+
+@periodic_task(run_every=datetime.timedelta(days=1))
+def update_search_shards():
+    """Queues updates of all shards of the global index.
+
+    This drops the docs of projects that were made private or deleted by
+    other means than the syncs with GitHub, such as the admin.
+    """
+    for number in range(settings.SEARCH_SHARDS):
+        queue_search_shard(number)
+
+
+@periodic_task(run_every=datetime.timedelta(days=1))
+def collect_garbage(dry_run=None):
+    """Deletes the stored docs and artifacts that are no longer used.
+
+    Nothing is deleted in a dry run, which defaults to DOCS_GC_DRY_RUN.
+    """
+    if dry_run is None:
+        dry_run = settings.DOCS_GC_DRY_RUN
+    collector = garbage.collect(docs_storage, dry_run)
+    logger.info('%s %s keys of %s bytes' % (
+        'Found' if dry_run else 'Deleted', collector.deleted, collector.bytes))
+    metrics.record('Docs/Garbage/Keys', collector.deleted)
+    metrics.record('Docs/Garbage/Bytes', collector.bytes)
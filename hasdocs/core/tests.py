@@ -1,16 +1,888 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import datetime
+import fcntl
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
 
-Replace this with more appropriate tests for your application.
-"""
+import mock
+import requests
+from boto.exception import BotoServerError
+from boto.s3.prefix import Prefix
+from celery.exceptions import Ignore
 
+from django.core.cache import cache, get_cache
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 
+from hasdocs.accounts.models import User
+from hasdocs.core import archives, garbage, github, search, tasks
+from hasdocs.core.logs import BuildLog
+from hasdocs.projects.models import Build, Generator, LogChunk, Project, \
+    SearchShard
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+
+def local_cache():
+    """Returns an empty in-memory cache for a test."""
+    local = get_cache('django.core.cache.backends.locmem.LocMemCache')
+    local.clear()
+    return local
+
+
+class FakeStorage(object):
+    """Storage of files in memory, serving ranged reads as a bucket does."""
+
+    reduced_redundancy = True
+
+    def __init__(self):
+        self.files = {}
+        self.bucket = self
+
+    def open(self, name, mode='rb'):
+        return io.BytesIO(self.files[name])
+
+    def save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def new_key(self, name):
+        storage = self
+
+        class Key(object):
+            def get_contents_as_string(self, headers):
+                start, end = headers['Range'][len('bytes='):].split('-')
+                return storage.files[name][int(start):int(end) + 1]
+        return Key()
+
+
+class FakeBucket(object):
+    """Bucket listing and deleting the files of a FakeStorage."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.name = 'docs'
+        # Last modified time of each file, as S3 lists it
+        self.modified = {}
+        self.copied = []
+
+    def key(self, name):
+        key = mock.Mock(size=len(self.storage.files[name]),
+                        last_modified=self.modified.get(
+                            name, '2013-01-01T00:00:00.000Z'))
+        # The name of a mock is its repr, so it is set afterwards
+        key.name = name
+        return key
+
+    def list(self, prefix='', delimiter=None):
+        names = sorted(name for name in self.storage.files
+                       if name.startswith(prefix))
+        if not delimiter:
+            return [self.key(name) for name in names]
+        prefixes = sorted(set(
+            prefix + name[len(prefix):].split(delimiter)[0] + delimiter
+            for name in names if delimiter in name[len(prefix):]))
+        return [Prefix(self, name) for name in prefixes]
+
+    def delete_keys(self, names, quiet=False):
+        for name in names:
+            del self.storage.files[name]
+        return mock.Mock(errors=[])
+
+    def get_key(self, name):
+        if name in self.storage.files:
+            return self.key(name)
+        return None
+
+    def copy_key(self, new_name, bucket_name, src_name, **kwargs):
+        self.copied.append(src_name)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write('index.html', '<title>Install guide</title>'
+                   '<p>Install the package with pip.</p>'
+                   '<script>var hidden = 1;</script>')
+        self.write('api.html', '<title>API</title>'
+                   '<p>Installation notes for functions &amp; classes.</p>')
+        self.write('genindex.html', '<title>Index</title><p>install</p>')
+        self.index = search.build_index(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, html):
+        with open(os.path.join(self.path, name), 'w') as fp:
+            fp.write(html)
+
+    def test_build_index(self):
+        """Tests that the visible words of the pages are indexed."""
+        self.assertEqual(sorted(doc[0] for doc in self.index['docs']),
+                         ['api.html', 'index.html'])
+        self.assertEqual(self.index['terms'], sorted(self.index['terms']))
+        self.assertIn('installation', self.index['terms'])
+        self.assertNotIn('hidden', self.index['terms'])
+        self.assertNotIn('index', self.index['terms'])
+
+    def test_query(self):
+        """Tests that pages must match every word of a query."""
+        total, results = search.query(self.index, 'install')
+        self.assertEqual(total, 1)
+        self.assertEqual(results[0]['path'], 'index.html')
+        self.assertEqual(results[0]['title'], 'Install guide')
+        self.assertEqual(search.query(self.index, 'install functions')[0], 0)
+        total, results = search.query(self.index, 'install* functions')
+        self.assertEqual([result['path'] for result in results],
+                         ['api.html'])
+
+    def test_query_prefix(self):
+        """Tests that a trailing asterisk matches the words it prefixes."""
+        total, results = search.query(self.index, 'INSTALL*')
+        self.assertEqual(total, 2)
+        # Words of the title weigh more
+        self.assertEqual(results[0]['path'], 'index.html')
+        self.assertEqual(search.query(self.index, 'install*', offset=1)[1],
+                         results[1:])
+
+    def test_merge_and_split(self):
+        """Tests that merged indexes are split back into the same indexes."""
+        other = {'docs': [['guide.html', 'Guide', 2]], 'terms': ['install'],
+                 'postings': [[[0, 1]]]}
+        merged = search.merge_indexes([('alice/one', self.index),
+                                       ('bob/two', other)])
+        self.assertEqual(len(merged['docs']), 3)
+        self.assertEqual(merged['length'],
+                         sum(doc[2] for doc in merged['docs']))
+        self.assertEqual(search.split_index(merged),
+                         {'alice/one': self.index, 'bob/two': other})
+
+    def test_query_shards(self):
+        """Tests that shards are queried together with facets by project."""
+        other = {'docs': [['guide.html', 'Guide', 2]], 'terms': ['install'],
+                 'postings': [[[0, 1]]]}
+        shards = [search.merge_indexes([('alice/one', self.index)]),
+                  search.merge_indexes([('bob/two', other)])]
+        result = search.query_shards(shards, 'install')
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(sorted(result['facets']),
+                         [('alice/one', 1), ('bob/two', 1)])
+        # Pages are scored as if the shards were one index
+        merged = search.merge_indexes([('alice/one', self.index),
+                                       ('bob/two', other)])
+        self.assertEqual(result, search.query_shards([merged], 'install'))
+        result = search.query_shards(shards, 'install', 'bob/two')
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['results'][0]['path'], 'guide.html')
+
+
+@override_settings(SEARCH_SHARDS=2)
+class SearchShardTest(TestCase):
+    def setUp(self):
+        self.storage = FakeStorage()
+        generator = Generator.objects.create(name='Sphinx')
+        self.projects = []
+        for login, private in (('alice', False), ('bob', False),
+                               ('carol', True)):
+            owner = User.objects.create(login=login)
+            project = Project.objects.create(
+                owner=owner, name='proj', generator=generator,
+                private=private, html_url='https://github.com/%s' % login)
+            self.projects.append(project)
+            self.publish(project, [['index.html', login.title(), 1]])
+        for target, value in (('hasdocs.core.archives.cache', local_cache()),
+                              ('hasdocs.core.tasks.cache', local_cache()),
+                              ('hasdocs.core.tasks.docs_storage',
+                               self.storage)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        archives.indexes.clear()
+        archives.shards.clear()
+
+    def publish(self, project, docs):
+        """Stores an index of the docs as the project's published index."""
+        name = search.index_name({'owner': project.owner.login,
+                                  'name': project.name,
+                                  'build': len(self.storage.files)})
+        self.storage.files[name] = archives.dump_index(
+            {'docs': docs, 'terms': [], 'postings': []})
+        Project.objects.filter(pk=project.pk).update(
+            search_index=name, search_shard=search.shard_of(project.pk))
+
+    def full_name(self, project):
+        return '%s/%s' % (project.owner.login, project.name)
+
+    def shard(self, number):
+        """Returns the published shard's pages by project."""
+        shard = SearchShard.objects.get(number=number)
+        return search.split_index(archives.load_index(
+            self.storage, shard.index, archives.shards))
+
+    def test_update(self):
+        """Tests that a shard lists the public projects it is for."""
+        alice, bob, carol = self.projects
+        number = search.shard_of(alice.pk)
+        tasks.update_search_shard(number)
+        expected = [self.full_name(project) for project in self.projects
+                    if search.shard_of(project.pk) == number and
+                    not project.private]
+        self.assertEqual(sorted(self.shard(number)), sorted(expected))
+
+    def test_update_incremental(self):
+        """Tests that only the indexes published since are read."""
+        alice, bob, carol = self.projects
+        number = search.shard_of(alice.pk)
+        Project.objects.exclude(pk=alice.pk).update(search_shard=number,
+                                                    private=False)
+        tasks.update_search_shard(number)
+        # The unchanged projects are taken from the previous shard
+        for project in (bob, carol):
+            del self.storage.files[Project.objects.get(
+                pk=project.pk).search_index]
+        self.publish(alice, [['api.html', 'API', 1]])
+        Project.objects.filter(pk=carol.pk).update(private=True)
+        tasks.update_search_shard(number)
+        shard = self.shard(number)
+        self.assertEqual(sorted(shard),
+                         [self.full_name(alice), self.full_name(bob)])
+        self.assertEqual(shard[self.full_name(alice)]['docs'],
+                         [['api.html', 'API', 1]])
+
+
+class BuildLogTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(login='alice')
+        generator = Generator.objects.create(name='Sphinx')
+        project = Project.objects.create(owner=owner, name='proj',
+                                         generator=generator)
+        self.build = Build.objects.create(project=project,
+                                          status=Build.UNKNOWN)
+        self.channel = mock.Mock()
+
+    def output(self):
+        return ''.join(chunk.text() for chunk in
+                       LogChunk.objects.filter(build=self.build))
+
+    def messages(self):
+        return [call[0][1]['message']
+                for call in self.channel.trigger.call_args_list]
+
+    def test_pushes_lines(self):
+        """Tests that only complete lines are pushed when flushed."""
+        log = BuildLog(self.build.pk, self.channel)
+        log.write('one\ntw')
+        log.flush()
+        log.write('o\n')
+        log.close()
+        self.assertEqual(self.messages(), [u'one\n', u'two\n'])
+        self.assertEqual(self.output(), 'one\ntwo\n')
+
+    @override_settings(BUILD_LOG_FLUSH_SIZE=4)
+    def test_flush_size(self):
+        """Tests that lines are pushed once BUILD_LOG_FLUSH_SIZE is reached."""
+        log = BuildLog(self.build.pk, self.channel)
+        log.write('a\n')
+        self.assertFalse(self.channel.trigger.called)
+        log.write('bc\n')
+        self.assertEqual(self.messages(), [u'a\nbc\n'])
+
+    @override_settings(BUILD_LOG_CHUNK_SIZE=6)
+    def test_saves_in_chunks(self):
+        """Tests that the output is stored every BUILD_LOG_CHUNK_SIZE."""
+        log = BuildLog(self.build.pk, self.channel)
+        log.write('one\n')
+        self.assertEqual(self.output(), '')
+        log.write('two\n')
+        self.assertEqual(self.output(), 'one\ntwo\n')
+        log.write('end')
+        log.close()
+        self.assertEqual(self.output(), 'one\ntwo\nend')
+        self.assertEqual(list(LogChunk.objects.filter(
+            build=self.build).values_list('number', 'size')), [(0, 8), (1, 3)])
+
+    @override_settings(BUILD_LOG_CHUNK_SIZE=10, BUILD_LOG_TAIL_SIZE=10)
+    def test_tail(self):
+        """Tests that only the last lines are kept on the build."""
+        log = BuildLog(self.build.pk, self.channel)
+        for i in range(5):
+            log.write('line %s\n' % i)
+        log.write('end')
+        log.close()
+        build = Build.objects.get(pk=self.build.pk)
+        self.assertEqual(log.tail(), 'line 4\nend')
+        self.assertEqual(build.output, 'line 4\nend')
+        self.assertEqual(build.output_size, 38)
+        self.assertTrue(build.is_output_truncated())
+
+    @override_settings(BUILD_LOG_TAIL_SIZE=4)
+    def test_sizes_in_bytes(self):
+        """Tests that sizes are counted in bytes of the encoded output."""
+        log = BuildLog(self.build.pk, self.channel)
+        log.write(u'\xe9t\xe9\n'.encode('utf-8'))
+        log.write('ok\n')
+        log.close()
+        build = Build.objects.get(pk=self.build.pk)
+        self.assertEqual(build.output_size, 9)
+        self.assertEqual(build.output, 'ok\n')
+        self.assertFalse(Build(output=u'\xe9t\xe9\n',
+                               output_size=6).is_output_truncated())
+
+    def test_retry_continues_chunks(self):
+        """Tests that a retried stage numbers its chunks after the stored."""
+        for attempt in range(2):
+            log = BuildLog(self.build.pk, self.channel)
+            log.write('attempt %s\n' % attempt)
+            log.close()
+        self.assertEqual(list(LogChunk.objects.filter(
+            build=self.build).values_list('number', flat=True)), [0, 1])
+        self.assertEqual(self.output(), 'attempt 0\nattempt 1\n')
+
+    @override_settings(BUILD_LOG_FLUSH_SIZE=2)
+    def test_long_line(self):
+        """Tests that long lines are split between characters."""
+        log = BuildLog(self.build.pk, self.channel)
+        data = u'\xe9\xe9\xe9'.encode('utf-8')
+        log.write(data[:3])
+        log.write(data[3:])
+        log.write('\n')
+        log.close()
+        self.assertEqual(''.join(self.messages()), u'\xe9\xe9\xe9\n')
+        for message in self.messages():
+            self.assertNotIn(u'\ufffd', message)
+
+
+class VirtualenvTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        patcher = mock.patch('hasdocs.core.tasks.python_version',
+                             lambda: 'Python 2.7.3')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def key(self, login, requirements):
+        with open(os.path.join(self.path, 'requirements.txt'), 'w') as fp:
+            fp.write(requirements)
+        return tasks.virtualenv_key({
+            'owner': login, 'name': 'proj', 'path': self.path,
+            'requirements_path': 'requirements.txt'})
+
+    def test_key(self):
+        """Tests that virtualenvs are shared by an owner's requirements."""
+        self.assertEqual(self.key('alice', 'sphinx'),
+                         self.key('alice', 'sphinx'))
+        self.assertNotEqual(self.key('alice', 'sphinx'),
+                            self.key('alice', 'sphinx\ndocutils'))
+        self.assertNotEqual(self.key('alice', 'sphinx'),
+                            self.key('bob', 'sphinx'))
+
+    def test_prune(self):
+        """Tests that only the old virtualenvs no build uses are removed."""
+        for name in ('old', 'used', 'recent'):
+            os.mkdir(os.path.join(self.path, name))
+        past = time.time() - 120
+        for name in ('old', 'used'):
+            os.utime(os.path.join(self.path, name), (past, past))
+        with open(os.path.join(self.path, 'used.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self.settings(VENV_ROOT=self.path, VENV_LOCAL_AGE=60):
+                tasks.prune_virtualenvs()
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['old.lock', 'recent', 'used', 'used.lock'])
+
+
+class GitHubRequestTest(TestCase):
+    def setUp(self):
+        self.cache = local_cache()
+        for target, value in (('hasdocs.core.github.cache', self.cache),
+                              ('hasdocs.core.github.session', mock.Mock())):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.params = {'access_token': 'token'}
+
+    def respond(self, status=200, **headers):
+        """Makes the session return a response with the given headers."""
+        response = mock.Mock(status_code=status, text='')
+        response.headers = dict(
+            (key.replace('_', '-'), value)
+            for key, value in headers.iteritems())
+        github.session.request.return_value = response
+        return response
+
+    def test_records_budget(self):
+        """Tests that the remaining budget of the token is kept."""
+        reset = int(time.time()) + 60
+        response = self.respond(x_ratelimit_remaining='4999',
+                                x_ratelimit_reset=str(reset))
+        self.assertEqual(github.request('GET', '/user', self.params),
+                         response)
+        self.assertEqual(self.cache.get(github.budget_key(self.params)),
+                         {'remaining': 4999, 'reset': reset})
+
+    @override_settings(GITHUB_API_RESERVE=100)
+    def test_keeps_reserve(self):
+        """Tests that the reserve of the budget is left to other requests."""
+        self.cache.set(github.budget_key(self.params),
+                       {'remaining': 100, 'reset': time.time() + 60})
+        self.respond()
+        self.assertRaises(github.RateLimited, github.request, 'GET', '/user',
+                          self.params)
+        self.assertFalse(github.session.request.called)
+        github.request('GET', '/user', self.params, reserve=0)
+        self.assertTrue(github.session.request.called)
+        # Other tokens have their own budgets
+        github.request('GET', '/user', {'access_token': 'other'})
+
+    def test_rate_limited(self):
+        """Tests that requests turned down for their rate are raised."""
+        self.respond(403, retry_after='30')
+        try:
+            github.request('GET', '/user', self.params)
+        except github.RateLimited as exc:
+            self.assertEqual(exc.wait, 30)
+        else:
+            self.fail('RateLimited not raised')
+        self.respond(403, x_ratelimit_remaining='0',
+                     x_ratelimit_reset=str(int(time.time()) + 120))
+        try:
+            github.request('GET', '/user', self.params)
+        except github.RateLimited as exc:
+            self.assertTrue(100 < exc.wait <= 120)
+        else:
+            self.fail('RateLimited not raised')
+
+    def test_other_errors(self):
+        """Tests that other errors are returned as responses."""
+        response = self.respond(404)
+        self.assertEqual(github.request('GET', '/user', self.params),
+                         response)
+
+    @override_settings(GITHUB_API_BACKOFF=60, GITHUB_API_JITTER=0)
+    def test_retry_delay(self):
+        """Tests that unknown waits back off with the retries."""
+        self.assertEqual(github.retry_delay(github.RateLimited(), 0), 60)
+        self.assertEqual(github.retry_delay(github.RateLimited(), 2), 240)
+        self.assertEqual(github.retry_delay(github.RateLimited(30), 2), 30)
+
+
+class BuildTaskTest(TestCase):
+    def http_error(self, status):
+        response = requests.Response()
+        response.status_code = status
+        error = requests.HTTPError()
+        error.response = response
+        return error
+
+    def test_is_transient(self):
+        """Tests that only the errors that may go away are retried."""
+        self.assertTrue(tasks.is_transient(requests.ConnectionError()))
+        self.assertTrue(tasks.is_transient(requests.Timeout()))
+        self.assertTrue(tasks.is_transient(self.http_error(502)))
+        self.assertFalse(tasks.is_transient(self.http_error(404)))
+        self.assertTrue(tasks.is_transient(BotoServerError(503, 'Slow')))
+        self.assertFalse(tasks.is_transient(BotoServerError(403, 'Denied')))
+        self.assertTrue(tasks.is_transient(github.RateLimited(10)))
+        self.assertFalse(tasks.is_transient(ValueError()))
+
+
+class WheelDirTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_wheel_dir(self):
+        """Tests that owners get their own wheels and unused ones go."""
+        for name in ('bob', 'carol'):
+            os.mkdir(os.path.join(self.path, name))
+        past = time.time() - 120
+        os.utime(os.path.join(self.path, 'bob'), (past, past))
+        with self.settings(WHEEL_DIR=self.path, WHEEL_LOCAL_AGE=60):
+            path = tasks.wheel_dir({'owner': 'alice'})
+        self.assertEqual(path, os.path.join(self.path, 'alice'))
+        self.assertEqual(sorted(os.listdir(self.path)), ['alice', 'carol'])
+
+
+class UpdateDocsTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(login='alice')
+        generator = Generator.objects.create(name='Jekyll')
+        self.project = Project.objects.create(owner=owner, name='proj',
+                                              generator=generator)
+        patcher = mock.patch('hasdocs.core.tasks.schedule_builds')
+        self.schedule_builds = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_coalesce(self):
+        """Tests that a queued build is reused by later triggers."""
+        build = tasks.update_docs(self.project, priority=Build.BULK)
+        self.assertEqual(build.status, Build.QUEUED)
+        self.assertTrue(self.schedule_builds.delay.called)
+        self.assertEqual(tasks.update_docs(self.project).pk, build.pk)
+        self.assertEqual(Build.objects.count(), 1)
+        # Raises the priority of the queued build to the trigger's
+        self.assertEqual(Build.objects.get(pk=build.pk).priority,
+                         Build.WEBHOOK)
+
+    def test_supersede(self):
+        """Tests that running builds are superseded by a new build."""
+        running = tasks.update_docs(self.project)
+        Build.objects.filter(pk=running.pk).update(status=Build.BUILDING)
+        build = tasks.update_docs(self.project)
+        self.assertNotEqual(build.pk, running.pk)
+        self.assertTrue(Build.objects.is_superseded(running.pk))
+        self.assertFalse(Build.objects.is_superseded(build.pk))
+
+
+class BuildTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        owner = User.objects.create(login='alice')
+        generator = Generator.objects.create(name='Jekyll')
+        self.project = Project.objects.create(owner=owner, name='proj',
+                                              generator=generator)
+        patcher = mock.patch('hasdocs.core.tasks.pusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+
+    def tarball(self, build):
+        source = os.path.join(self.root, 'alice-proj-abc123')
+        if not os.path.isdir(source):
+            os.makedirs(os.path.join(source, 'docs'))
+            with open(os.path.join(source, 'docs', 'index.md'), 'w') as fp:
+                fp.write('# Docs\n')
+        filename = os.path.join(self.root, '%s.tar.gz' % build.pk)
+        with tarfile.open(filename, 'w:gz') as tar:
+            tar.add(source, 'alice-proj-abc123')
+        return dict(tasks.build_spec(build), filename=filename)
+
+    def test_extract(self):
+        """Tests that builds of the same commit get their own directory."""
+        paths = []
+        with self.settings(BUILD_ROOT=self.root):
+            for i in range(2):
+                build = Build.objects.create(project=self.project,
+                                             status=Build.BUILDING)
+                spec = tasks.extract(self.tarball(build))
+                paths.append(spec['path'])
+                self.assertEqual(os.path.dirname(spec['path']), self.root)
+                self.assertTrue(os.path.exists(
+                    os.path.join(spec['path'], 'docs', 'index.md')))
+                self.assertFalse(os.path.exists(spec['filename']))
+        self.assertNotEqual(paths[0], paths[1])
+
+    def test_stop_superseded(self):
+        """Tests that a running build is stopped once superseded."""
+        os.mkdir('bin')
+        with open(os.path.join('bin', 'build_jekyll'), 'w') as fp:
+            fp.write('echo started\nsleep 60\n')
+        build = Build.objects.create(project=self.project,
+                                     status=Build.BUILDING)
+        spec = dict(tasks.build_spec(build), path=self.root)
+        started_at = time.time()
+        with mock.patch.object(Build.objects, 'is_superseded',
+                               side_effect=[False, True]):
+            with self.settings(BUILD_SUPERSEDED_INTERVAL=0):
+                self.assertEqual(tasks.build_docs(spec), spec)
+        self.assertLess(time.time() - started_at, 30)
+        self.assertEqual(Build.objects.get(pk=build.pk).status,
+                         Build.BUILDING)
+
+    def test_store_sphinx_env_retry(self):
+        """Tests that a retry does not fail on the link already removed."""
+        build = Build.objects.create(project=self.project,
+                                     status=Build.BUILDING)
+        link = os.path.join(self.root, 'build-0-previous')
+        os.symlink(self.root, link)
+        spec = dict(tasks.build_spec(build), path=self.root,
+                    previous_path=link)
+        target = os.path.join(self.root, 'docs', '_build', 'html')
+        with mock.patch('hasdocs.core.tasks.target_dir', lambda s: target):
+            for attempt in range(2):
+                self.assertEqual(tasks.store_sphinx_env(spec), spec)
+        self.assertFalse(os.path.lexists(link))
+
+    def test_bundle_docs_without_epub(self):
+        """Tests that a build without its epub is left without a bundle."""
+        build = Build.objects.create(project=self.project,
+                                     status=Build.BUILDING)
+        spec = dict(tasks.build_spec(build), path=self.root,
+                    generator='Sphinx', offline_format='epub',
+                    venv_key='venv')
+        target = os.path.join(self.root, 'docs', '_build', 'html')
+        os.makedirs(os.path.join(self.root, 'docs', '_build', 'epub'))
+        with mock.patch('hasdocs.core.tasks.target_dir', lambda s: target):
+            with mock.patch('hasdocs.core.tasks.subprocess') as subprocess:
+                with mock.patch('hasdocs.core.tasks.docs_storage') as storage:
+                    self.assertEqual(tasks.bundle_docs(spec), spec)
+        self.assertTrue(subprocess.check_output.called)
+        self.assertFalse(storage.save.called)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, 'docs', '_build', 'epub')))
+
+
+class ScheduleBuildsTest(TestCase):
+    def setUp(self):
+        self.generator = Generator.objects.create(name='Jekyll')
+        patcher = mock.patch('hasdocs.core.tasks.dispatch_build')
+        self.dispatch_build = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('hasdocs.core.tasks.metrics')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, owner, name, priority=Build.WEBHOOK):
+        project = Project.objects.create(
+            owner=owner, name=name, generator=self.generator,
+            html_url='https://github.com/%s/%s' % (owner, name))
+        return Build.objects.create(project=project, status=Build.QUEUED,
+                                    priority=priority)
+
+    def dispatched(self):
+        return [call[0][0].pk for call in self.dispatch_build.call_args_list]
+
+    @override_settings(BUILD_CONCURRENCY=2, BUILD_OWNER_CONCURRENCY=1)
+    def test_limits(self):
+        """Tests that builds are dispatched within the concurrency limits."""
+        alice = User.objects.create(login='alice')
+        bob = User.objects.create(login='bob')
+        first = self.queue(alice, 'one', priority=Build.INTERACTIVE)
+        self.queue(alice, 'two')
+        other = self.queue(bob, 'three', priority=Build.BULK)
+        self.queue(bob, 'four', priority=Build.BULK)
+        tasks.dispatch_builds()
+        self.assertEqual(self.dispatched(), [first.pk, other.pk])
+        tasks.dispatch_builds()
+        self.assertEqual(self.dispatch_build.call_count, 2)
+
+    def test_superseded_running(self):
+        """Tests that superseded builds count until their chain ends."""
+        alice = User.objects.create(login='alice')
+        running = self.queue(alice, 'one')
+        Build.objects.filter(pk=running.pk).update(
+            status=Build.SUPERSEDED, dispatched_at=timezone.now())
+        build = self.queue(alice, 'two')
+        tasks.dispatch_builds()
+        self.assertFalse(self.dispatch_build.called)
+        Build.objects.filter(pk=running.pk).update(finished_at=timezone.now())
+        tasks.dispatch_builds()
+        self.assertEqual(self.dispatched(), [build.pk])
+
+    def test_lock(self):
+        """Tests that a run holding the lock runs again when asked to."""
+        with mock.patch('hasdocs.core.tasks.dispatch_builds') as dispatch:
+            cache.add('schedule-builds:lock', True)
+            tasks.schedule_builds()
+            self.assertFalse(dispatch.called)
+            cache.delete('schedule-builds:lock')
+
+            def trigger():
+                if dispatch.call_count == 1:
+                    tasks.schedule_builds()
+            dispatch.side_effect = trigger
+            tasks.schedule_builds()
+            self.assertEqual(dispatch.call_count, 2)
+
+
+class FetchSourceTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(login='alice')
+        generator = Generator.objects.create(name='Jekyll')
+        self.project = Project.objects.create(owner=owner, name='proj',
+                                              generator=generator)
+        for name in ('latest_commit', 'github.request', 'schedule_builds'):
+            patcher = mock.patch('hasdocs.core.tasks.%s' % name)
+            setattr(self, name.split('.')[-1], patcher.start())
+            self.addCleanup(patcher.stop)
+        self.latest_commit.return_value = 'abc123'
+
+    def test_unchanged(self):
+        """Tests that builds of the published commit are skipped."""
+        Build.objects.create(project=self.project, status=Build.SUCCESS,
+                             commit='abc123',
+                             fingerprint=self.project.fingerprint())
+        build = Build.objects.create(project=self.project,
+                                     status=Build.QUEUED)
+        self.assertRaises(Ignore, tasks.fetch_source,
+                          tasks.build_spec(build))
+        build = Build.objects.get(pk=build.pk)
+        self.assertEqual(build.status, Build.UNCHANGED)
+        self.assertTrue(build.finished_at)
+        self.assertFalse(self.request.called)
+
+    def test_changed(self):
+        """Tests that builds after a skipped build are not skipped."""
+        Build.objects.create(project=self.project, status=Build.SUCCESS,
+                             commit='abc000',
+                             fingerprint=self.project.fingerprint())
+        Build.objects.create(project=self.project, status=Build.UNCHANGED,
+                             commit='abc123',
+                             fingerprint=self.project.fingerprint())
+        build = Build.objects.create(project=self.project,
+                                     status=Build.QUEUED)
+        self.request.return_value.content = 'tarball'
+        with self.settings(BUILD_ROOT=tempfile.mkdtemp()):
+            spec = tasks.fetch_source(tasks.build_spec(build))
+        self.assertEqual(Build.objects.get(pk=build.pk).status,
+                         Build.BUILDING)
+        shutil.rmtree(os.path.dirname(spec['filename']))
+
+
+class ArchivesTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'docs', '_static'))
+        self.files = {
+            'index.html': '<p>Index</p>',
+            'api.html': '<p>API</p>' * 100,
+            '_static/style.css': 'body { margin: 0 }',
+        }
+        for name, content in self.files.iteritems():
+            with open(os.path.join(self.path, 'docs', name), 'w') as fp:
+                fp.write(content)
+        patcher = mock.patch('hasdocs.core.archives.cache', local_cache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        archives.indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_create_archive(self):
+        """Tests that shared files are left out of the archive as blobs."""
+        filename = os.path.join(self.path, 'docs.tar')
+        index, blobs = archives.create_archive(
+            os.path.join(self.path, 'docs'), filename)
+        self.assertEqual(sorted(index), sorted(self.files))
+        digest = index['_static/style.css']
+        self.assertEqual(blobs, {digest: os.path.join(
+            self.path, 'docs', '_static', 'style.css')})
+        with tarfile.open(filename) as tar:
+            self.assertEqual(sorted(tar.getnames()),
+                             ['api.html', 'index.html'])
+
+    def test_read_member(self):
+        """Tests that files are read back from the archive and blobs."""
+        filename = os.path.join(self.path, 'docs.tar')
+        index, blobs = archives.create_archive(
+            os.path.join(self.path, 'docs'), filename)
+        storage = FakeStorage()
+        archive = archives.archive_name(
+            {'owner': 'alice', 'name': 'proj', 'build': 1})
+        with open(filename, 'rb') as fp:
+            storage.files[archive] = fp.read()
+        storage.files[archives.index_name(archive)] = archives.dump_index(
+            index)
+        for digest, path in blobs.iteritems():
+            with open(path, 'rb') as fp:
+                storage.files[archives.blob_name(digest)] = fp.read()
+        for name, content in self.files.iteritems():
+            self.assertEqual(
+                archives.read_member(storage, archive, name), content)
+        self.assertRaises(IOError, archives.read_member, storage, archive,
+                          'missing.html')
+
+
+@override_settings(DOCS_GC_BATCH_SIZE=2, DOCS_GC_BATCH_DELAY=0)
+class GarbageTest(TestCase):
+    def setUp(self):
+        self.storage = FakeStorage()
+        self.storage.bucket = FakeBucket(self.storage)
+        owner = User.objects.create(login='alice')
+        generator = Generator.objects.create(name='Sphinx')
+        self.project = Project.objects.create(owner=owner, name='proj',
+                                              generator=generator)
+        for target in ('hasdocs.core.archives.cache',
+                       'hasdocs.core.garbage.cache'):
+            patcher = mock.patch(target, local_cache())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        archives.indexes.clear()
+
+    def recent(self, name):
+        """Marks the stored file as just modified."""
+        self.storage.bucket.modified[name] = (
+            datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+    def test_dry_run(self):
+        """Tests that a dry run deletes nothing but counts the garbage."""
+        self.storage.files['bob/gone/index.html'] = 'gone'
+        collector = garbage.collect(self.storage, dry_run=True)
+        self.assertEqual((collector.deleted, collector.bytes), (1, 4))
+        self.assertIn('bob/gone/index.html', self.storage.files)
+        garbage.collect(self.storage)
+        self.assertNotIn('bob/gone/index.html', self.storage.files)
+
+    @override_settings(DOCS_GC_MAX_DELETES=3)
+    def test_max_deletes(self):
+        """Tests that a collection stops after DOCS_GC_MAX_DELETES keys."""
+        for i in range(5):
+            self.storage.files['bob/gone/%s.html' % i] = 'gone'
+        self.assertEqual(garbage.collect(self.storage).deleted, 3)
+        self.assertEqual(len(self.storage.files), 2)
+
+    def test_live_blobs(self):
+        """Tests that blobs are kept while an archive or a build uses them."""
+        archive = archives.archive_name(
+            {'owner': 'alice', 'name': 'proj', 'build': 1})
+        self.storage.files[archive] = ''
+        self.storage.files[archives.index_name(archive)] = (
+            archives.dump_index({'style.css': 'used'}))
+        Project.objects.filter(pk=self.project.pk).update(
+            docs_archive=archive)
+        for digest in ('used', 'unused', 'new'):
+            self.storage.files[archives.blob_name(digest)] = digest
+        self.recent(archives.blob_name('new'))
+        garbage.collect(self.storage)
+        self.assertEqual(
+            sorted(name for name in self.storage.files if '/blobs/' in name),
+            [archives.blob_name('new'), archives.blob_name('used')])
+        self.assertIn(archive, self.storage.files)
+
+    def test_touch_reused_blob(self):
+        """Tests that a build reusing a stored blob renews it once."""
+        name = archives.blob_name('used')
+        self.storage.files[name] = 'used'
+        self.assertFalse(archives.store_blob(self.storage, 'used', None))
+        self.assertFalse(archives.store_blob(self.storage, 'used', None))
+        self.assertEqual(self.storage.bucket.copied, [name])
+
+
+class PruneBuildsTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_prune_builds(self):
+        """Tests that only what builds left for long is removed."""
+        for name in ('build-1-old', 'build-2-new'):
+            os.mkdir(os.path.join(self.path, name))
+        with open(os.path.join(self.path, 'old.tar.gz'), 'w') as fp:
+            fp.write('tarball')
+        os.symlink(os.path.join(self.path, 'build-2-new'),
+                   os.path.join(self.path, 'build-0-link'))
+        past = time.time() - 120
+        for name in ('build-1-old', 'old.tar.gz'):
+            os.utime(os.path.join(self.path, name), (past, past))
+        with self.settings(BUILD_ROOT=self.path, BUILD_TIMEOUT=60):
+            tasks.prune_builds()
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['build-0-link', 'build-2-new'])
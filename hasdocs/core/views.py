@@ -1,11 +1,15 @@
+import hashlib
 import json
 import logging
 import mimetypes
+from multiprocessing.pool import ThreadPool
 import requests
+import threading
 
 from storages.backends.s3boto import S3BotoStorage
 
 from django.conf import settings
+from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.mail import mail_managers
 from django.core.urlresolvers import reverse
@@ -19,9 +23,10 @@ from django.views.generic.edit import FormView
 
 from hasdocs.accounts.decorators import permission_required
 from hasdocs.accounts.models import Plan, BaseUser
+from hasdocs.core import archives, search
 from hasdocs.core.forms import ContactForm
 from hasdocs.core.tasks import update_docs
-from hasdocs.projects.models import Domain, Project
+from hasdocs.projects.models import Build, Domain, Project, SearchShard
 
 logger = logging.getLogger(__name__)
 docs_storage = S3BotoStorage(
@@ -46,21 +51,145 @@ def last_modified(request, project, path):
 @permission_required('read')
 @condition(last_modified_func=last_modified)
 def serve(request, project, path):
-    """Returns the requested static file from cache or S3."""
-    path = '/%s/%s/%s' % (request.subdomain, project, path)
-    logger.debug('Serving static file at %s' % path)
+    """Returns the requested static file from cache or S3.
+
+    The docs published as an archive are read from it by byte range.
+    """
+    try:
+        archive = Project.objects.values_list(
+            'docs_archive', flat=True
+        ).get(owner__login=request.subdomain, name=project)
+    except Project.DoesNotExist:
+        archive = ''
+    name = '/%s/%s/%s' % (request.subdomain, project, path)
+    logger.debug('Serving static file at %s' % name)
     try:
-        content = cache.get(path, docs_storage.open(path, 'r').read())
-        cache.add(path, content)
+        if archive:
+            content = archives.read_member(docs_storage, archive, path)
+        else:
+            content = cache.get(name)
+            if content is None:
+                content = docs_storage.open(name, 'r').read()
+                cache.add(name, content)
     except IOError:
         raise Http404
-    content_type, encoding = mimetypes.guess_type(path)
+    content_type, encoding = mimetypes.guess_type(name)
     response = HttpResponse(content, content_type=content_type)
     if encoding:
         response['Content-Encoding'] = encoding
     return response
 
 
+@permission_required('read')
+def search_docs(request, project, path):
+    """Returns the pages of the project's docs that best match the query.
+
+    The query is given as q, and the results are paged by offset and limit.
+    """
+    try:
+        name = Project.objects.values_list(
+            'search_index', flat=True
+        ).get(owner__login=request.subdomain, name=project)
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = min(int(request.GET.get('limit', 10)),
+                    settings.SEARCH_MAX_RESULTS)
+    except (Project.DoesNotExist, ValueError):
+        raise Http404
+    if not name:
+        raise Http404
+    try:
+        index = archives.load_index(docs_storage, name)
+    except IOError:
+        raise Http404
+    text = request.GET.get('q', '')
+    total, results = search.query(index, text, offset, limit)
+    for result in results:
+        result['url'] = '/%s/%s' % (project, result['path'])
+    return HttpResponse(
+        json.dumps({'query': text, 'total': total, 'results': results}),
+        content_type='application/json')
+
+
+@permission_required('read')
+def download_docs(request, project, path):
+    """Redirects to the project's docs bundled for reading offline."""
+    try:
+        name = Project.objects.values_list(
+            'offline_bundle', flat=True
+        ).get(owner__login=request.subdomain, name=project)
+    except Project.DoesNotExist:
+        raise Http404
+    if not name:
+        raise Http404
+    return HttpResponseRedirect(docs_storage.url(name))
+
+
+# Threads reading the shards of the global index, started on first use so
+# that processes forked after loading this module do not share them
+_shard_pool = None
+_shard_pool_lock = threading.Lock()
+
+
+def shard_pool():
+    """Returns the threads reading the shards of the global index."""
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            _shard_pool = ThreadPool(settings.SEARCH_SHARD_CONCURRENCY)
+        return _shard_pool
+
+
+def load_shard(name):
+    """Returns a stored shard of the global index, or None if unreadable."""
+    try:
+        return archives.load_index(docs_storage, name, archives.shards)
+    except IOError:
+        logger.warning('Failed to read search shard %s' % name)
+        return None
+
+
+def search_all(request):
+    """Returns the pages of all public docs that best match the query.
+
+    The query is given as q, and the results are paged by offset and limit.
+    They can be limited to one project, given as owner/name, and the number
+    of matching pages in each project is returned with them.
+    """
+    text = request.GET.get('q', '')
+    project = request.GET.get('project', '')
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = min(int(request.GET.get('limit', 10)),
+                    settings.SEARCH_MAX_RESULTS)
+    except ValueError:
+        raise Http404
+    names = sorted(SearchShard.objects.exclude(
+        index='').values_list('index', flat=True))
+    # Results are cached until a shard is updated
+    key = 'search:%s' % hashlib.sha1(json.dumps(
+        [names, search.parse(text), project])).hexdigest()
+    result = cache.get(key)
+    if result is None:
+        # Reads the shards that are not in memory concurrently
+        shards = [shard for shard in shard_pool().map(load_shard, names)
+                  if shard is not None]
+        result = search.query_shards(shards, text, project)
+        if len(shards) == len(names):
+            cache.set(key, result, settings.SEARCH_CACHE_TIMEOUT)
+    site = Site.objects.get_current().domain
+    results = []
+    for item in result['results'][offset:offset + limit]:
+        owner, name = item['project'].split('/', 1)
+        results.append(dict(item, url='http://%s.%s/%s/%s' % (
+            owner, site, name, item['path'])))
+    return HttpResponse(json.dumps({
+        'query': text,
+        'total': result['total'],
+        'facets': result['facets'],
+        'results': results,
+    }), content_type='application/json')
+
+
 def user_page(request):
     """Returns the page for the user, if any."""
     user = get_object_or_404(BaseUser, login=request.subdomain)
@@ -90,7 +219,7 @@ def restart_build(request, username, project):
     logger.info('Restarting build for %s/%s' % (username, project))
     if request.method == 'POST':
         project = Project.objects.get(owner__login=username, name=project)
-        build = update_docs(project)
+        build = update_docs(project, priority=Build.INTERACTIVE)
         return HttpResponseRedirect(reverse('project_build_detail', args=[
             username, project, build.pk]))
     else:
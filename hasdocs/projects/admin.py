@@ -1,11 +1,24 @@
 from django.contrib import admin
 
-from hasdocs.projects.models import Build, Domain, Generator, Language, Project
+from hasdocs.core.tasks import update_docs
+from hasdocs.projects.models import Build, Domain, Generator, Language, \
+    Project, SearchShard
+
+
+def rebuild_docs(modeladmin, request, queryset):
+    """Queues builds for the selected projects behind other builds."""
+    for project in queryset:
+        update_docs(project, priority=Build.BULK)
+rebuild_docs.short_description = 'Rebuild docs for the selected projects'
 
 
 class BuildAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'status', 'duration', 'finished_at')
 
+    def queryset(self, request):
+        """Leaves out the output when listing the builds."""
+        return super(BuildAdmin, self).queryset(request).defer('output')
+
 
 class DomainAdmin(admin.ModelAdmin):
     list_display = ('name', 'project')
@@ -14,9 +27,15 @@ class DomainAdmin(admin.ModelAdmin):
 class ProjectAdmin(admin.ModelAdmin):
     list_display = ('name', 'owner', 'language', 'generator', 'private',
                     'description')
+    actions = [rebuild_docs]
+
+
+class SearchShardAdmin(admin.ModelAdmin):
+    list_display = ('number', 'index', 'mod_date')
 
 admin.site.register(Build, BuildAdmin)
 admin.site.register(Domain, DomainAdmin)
 admin.site.register(Generator)
 admin.site.register(Language)
 admin.site.register(Project, ProjectAdmin)
+admin.site.register(SearchShard, SearchShardAdmin)
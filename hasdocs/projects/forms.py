@@ -7,4 +7,5 @@ class ProjectActivateForm(ModelForm):
     """Form for creating a post-receive hook for a project."""
     class Meta:
         model = Project
-        fields = ('language', 'generator', 'docs_path', 'requirements_path')
+        fields = ('language', 'generator', 'docs_path', 'requirements_path',
+                  'offline_format')
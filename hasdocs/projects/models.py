@@ -1,10 +1,14 @@
+import base64
+import hashlib
+import json
 import logging
+import zlib
 
 from storages.backends.s3boto import S3BotoStorage
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models
+from django.db import models, transaction
 
 from hasdocs.accounts.models import BaseUser, OthersPermission, Team, User
 
@@ -35,6 +39,69 @@ class Language(models.Model):
 
 class ProjectManager(models.Manager):
     """Manager for returning various project sets."""
+    # Fields of a project that are kept in sync with its GitHub repo
+    SYNCED_FIELDS = ('name', 'description', 'private', 'html_url', 'git_url')
+
+    def sync_repos(self, owner, repos):
+        """Creates or updates the owner's projects for the GitHub repos.
+
+        The repos are compared with the existing projects in memory, so that
+        new projects are inserted in bulk and only the changed projects are
+        updated. The read permissions for others are then rebuilt for all the
+        repos at once. Returns the numbers of created and updated projects,
+        and the ids of the projects whose docs the global search index lists
+        under a name or visibility they no longer have.
+        """
+        languages = dict(Language.objects.values_list('name', 'pk'))
+        with transaction.commit_on_success():
+            existing = self.select_related('owner').in_bulk(
+                [repo['id'] for repo in repos])
+            created = []
+            updated = 0
+            stale = set()
+            paths = set()
+            public_paths = set()
+            for repo in repos:
+                values = dict((key, repo.get(key))
+                              for key in self.SYNCED_FIELDS)
+                # Descriptions may be None
+                values['description'] = values['description'] or ''
+                language = languages.get(repo.get('language'))
+                if repo.get('language') and not language:
+                    logger.warning('Failed to find language %s' % (
+                        repo['language']))
+                project = existing.get(repo['id'])
+                if project is None:
+                    created.append(Project(id=repo['id'], owner=owner,
+                                           language_id=language, **values))
+                else:
+                    # Then the permissions of the project's old path go too,
+                    # which may be under another owner if it was transferred
+                    paths.add('/%s/%s/' % (project.owner.login, project.name))
+                    values['owner'] = owner.pk
+                    if language:
+                        values['language'] = language
+                    changes = dict(
+                        (key, value) for key, value in values.iteritems()
+                        if project.serializable_value(key) != value)
+                    if changes:
+                        self.filter(pk=project.pk).update(**changes)
+                        updated += 1
+                    if project.search_index and not project.private and (
+                            'private' in changes or 'owner' in changes or
+                            'name' in changes):
+                        # Then its shard lists the docs by their old values
+                        stale.add(project.pk)
+                path = '/%s/%s/' % (owner.login, values['name'])
+                paths.add(path)
+                if not values['private']:
+                    public_paths.add(path)
+            self.bulk_create(created)
+            OthersPermission.objects.filter(path__in=paths).delete()
+            OthersPermission.objects.bulk_create([
+                OthersPermission(path=public_path, permission='read')
+                for public_path in public_paths])
+        return len(created), updated, stale
 
     def owned_by(self, account, user):
         """Returns the projects owned by given user or organization account."""
@@ -66,6 +133,12 @@ class ProjectManager(models.Manager):
 
 class Project(models.Model):
     """Model for representing a software project."""
+    OFFLINE_FORMATS = (
+        ('', 'None'),
+        ('html', 'Compressed HTML'),
+        ('singlehtml', 'Single page HTML (Sphinx only)'),
+        ('epub', 'EPUB (Sphinx only)'),
+    )
     # Owner of the project
     owner = models.ForeignKey(BaseUser)
     # Name of the project
@@ -109,6 +182,22 @@ class Project(models.Model):
     pub_date = models.DateTimeField(auto_now_add=True)
     # Last modified date
     mod_date = models.DateTimeField(auto_now=True)
+    # Time the build of the published docs was dispatched, before any upload
+    published_at = models.DateTimeField(blank=True, null=True)
+    # Stored archive of the published docs, if published as an archive
+    docs_archive = models.CharField(max_length=255, blank=True)
+    # Stored full-text search index of the published docs
+    search_index = models.CharField(max_length=255, blank=True)
+    # Shard of the global index listing the published docs, if indexed
+    search_shard = models.PositiveIntegerField(
+        blank=True, null=True, db_index=True)
+    # Format of the docs to be downloaded for reading offline, if any
+    offline_format = models.CharField(
+        max_length=20, blank=True, choices=OFFLINE_FORMATS,
+        help_text="Choose a format to download the docs in, if any."
+    )
+    # Stored bundle of the published docs for reading offline
+    offline_bundle = models.CharField(max_length=255, blank=True)
     # Custom manager for the model
     objects = ProjectManager()
 
@@ -122,33 +211,6 @@ class Project(models.Model):
     def __unicode__(self):
         return self.name
 
-    @classmethod
-    def from_kwargs(cls, **kwargs):
-        """Creates and returns a new project from the given kwargs."""
-        owner = BaseUser.objects.get(id=kwargs.pop('owner')['id'])
-        try:
-            project = Project.objects.get(owner=owner, id=kwargs['id'])
-        except Project.DoesNotExist:
-            project = Project(owner=owner, id=kwargs['id'])
-        for key, value in project.__dict__.iteritems():
-            if key in kwargs:
-                setattr(project, key, kwargs.get(key))
-        # TODO: Quick hack to handle cases where description is None
-        if not project.description:
-            project.description = ''
-        # Sets project language
-        try:
-            language = Language.objects.get(name=kwargs['language'])
-            project.language = language
-        except Language.DoesNotExist:
-            logger.warning('Failed to find language %s' % kwargs['language'])
-        project.save()
-        path = '/%s/%s/' % (owner.login, project.name)
-        OthersPermission.objects.filter(path=path).delete()
-        if not project.private:
-            OthersPermission.objects.create(path=path, permission='read')
-        return project
-
     def is_owner(self, user):
         """Returns whether the user is owner of this project."""
         if self.owner.is_organization():
@@ -181,6 +243,14 @@ class Project(models.Model):
             else:
                 return True
 
+    def fingerprint(self):
+        """Returns the hash of the settings the docs are built with."""
+        values = [self.generator.name, self.docs_path, self.requirements_path]
+        if self.offline_format:
+            # Only when set, so that the hash of other projects is unchanged
+            values.append(self.offline_format)
+        return hashlib.sha1('\0'.join(values).encode('utf-8')).hexdigest()
+
     @models.permalink
     def get_absolute_url(self):
         """Returns the url for this project."""
@@ -191,36 +261,105 @@ class Project(models.Model):
         site = Site.objects.get_current().domain
         return 'http://%s.%s/%s/' % (self.owner, site, self.name)
 
+    def get_offline_url(self):
+        """Returns the url of the offline docs for this project."""
+        return '%s_offline/' % self.get_docs_url()
+
     def get_latest_build(self):
         """Returns the latest documentation build for this project."""
         try:
-            return self.build_set.order_by('-number')[0:1].get()
+            return self.build_set.defer('output').order_by(
+                '-number')[0:1].get()
+        except Build.DoesNotExist:
+            return None
+
+
+class BuildManager(models.Manager):
+    """Manager for querying builds by their primary keys."""
+
+    def is_superseded(self, pk):
+        """Returns whether a newer build has been queued for the project."""
+        return self.filter(pk=pk, status=Build.SUPERSEDED).exists()
+
+    def record_stage(self, pk, stats):
+        """Appends the stats of a stage to those stored for the build."""
+        stored = self.filter(pk=pk).values_list('stats', flat=True)[0]
+        stages = json.loads(stored or '[]')
+        stages.append(stats)
+        self.filter(pk=pk).update(stats=json.dumps(stages))
+
+    def published_source(self, project_id):
+        """Returns the commit and fingerprint of the published docs.
+
+        Only the builds that uploaded docs are considered, so skipped builds
+        are left out.
+        """
+        try:
+            return self.filter(
+                project=project_id, status=Build.SUCCESS
+            ).order_by('-number').values_list(
+                'commit', 'fingerprint')[0:1].get()
         except Build.DoesNotExist:
             return None
 
 
 class Build(models.Model):
     """Model for representing a documentation build."""
+    QUEUED = 'Q'
+    BUILDING = 'B'
     SUCCESS = 'S'
     FAILURE = 'F'
+    SUPERSEDED = 'X'
+    UNCHANGED = 'N'
     UNKNOWN = 'U'
     STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (BUILDING, 'Building'),
         (SUCCESS, 'Success'),
         (FAILURE, 'Failure'),
+        (SUPERSEDED, 'Superseded'),
+        (UNCHANGED, 'Unchanged'),
         (UNKNOWN, 'Unknown'),
     )
+    INTERACTIVE = 0
+    WEBHOOK = 1
+    BULK = 2
+    PRIORITY_CHOICES = (
+        (INTERACTIVE, 'Interactive'),
+        (WEBHOOK, 'Webhook'),
+        (BULK, 'Bulk'),
+    )
     # The project this build is for
     project = models.ForeignKey(Project)
     # Build number for the project
     number = models.IntegerField()
-    # Status of the build (e.g., building, finished, or failed)
+    # Status of the build (e.g., queued, building, finished, or failed)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES)
-    # Output from running the build
+    # Priority of the build in the queue, lower being more urgent
+    priority = models.PositiveSmallIntegerField(
+        choices=PRIORITY_CHOICES, default=WEBHOOK)
+    # Last part of the output from running the build
     output = models.TextField(blank=True)
-    # Time it started building the documentation
+    # Size of the entire output in bytes
+    output_size = models.PositiveIntegerField(default=0)
+    # Time it was queued
     started_at = models.DateTimeField(auto_now_add=True)
+    # Time it was sent to the workers
+    dispatched_at = models.DateTimeField(blank=True, null=True)
     # Time it finished building the documentation
-    finished_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    # JSON list of the time and resources used by each stage of the build
+    stats = models.TextField(blank=True)
+    # SHA of the commit the docs were built from
+    commit = models.CharField(max_length=40, blank=True)
+    # Hash of the project settings the docs were built with
+    fingerprint = models.CharField(max_length=40, blank=True)
+    # Last stage of the build that completed
+    checkpoint = models.CharField(max_length=50, blank=True)
+    # JSON spec of the build as of the checkpoint
+    spec = models.TextField(blank=True)
+    # Custom manager for the model
+    objects = BuildManager()
 
     class Meta:
         ordering = ['-started_at']
@@ -238,7 +377,21 @@ class Build(models.Model):
 
     def duration(self):
         """Returns the time it took for this build to build."""
-        return self.finished_at - self.started_at
+        if self.finished_at:
+            return self.finished_at - (self.dispatched_at or self.started_at)
+
+    def queue_time(self):
+        """Returns the time this build waited in the queue."""
+        if self.dispatched_at:
+            return self.dispatched_at - self.started_at
+
+    def stages(self):
+        """Returns the time and resources used by each stage of the build."""
+        return json.loads(self.stats or '[]')
+
+    def is_output_truncated(self):
+        """Returns whether the stored tail is only part of the output."""
+        return self.output_size > len(self.output.encode('utf-8'))
 
     @models.permalink
     def get_absolute_url(self):
@@ -246,6 +399,42 @@ class Build(models.Model):
         return ('project_build_detail',
                 [self.project.owner.login, self.project.name, self.pk])
 
+    @models.permalink
+    def get_log_url(self):
+        """Returns the url for the pages of the output of this build."""
+        return ('project_build_log',
+                [self.project.owner.login, self.project.name, self.pk])
+
+
+class LogChunk(models.Model):
+    """Model for representing a compressed chunk of a build's output."""
+    # The build this chunk of output is from
+    build = models.ForeignKey(Build)
+    # Position of this chunk in the output, starting from 0
+    number = models.PositiveIntegerField()
+    # Size of the uncompressed chunk in bytes
+    size = models.PositiveIntegerField()
+    # Base64 encoded zlib-compressed output
+    data = models.TextField()
+
+    class Meta:
+        ordering = ['number']
+        unique_together = ('build', 'number')
+
+    def __unicode__(self):
+        return '%s: chunk %s' % (self.build, self.number)
+
+    @classmethod
+    def from_text(cls, build_id, number, text):
+        """Returns a new compressed chunk for the given text."""
+        raw = text.encode('utf-8')
+        return cls(build_id=build_id, number=number, size=len(raw),
+                   data=base64.b64encode(zlib.compress(raw)))
+
+    def text(self):
+        """Returns the uncompressed output of this chunk."""
+        return zlib.decompress(base64.b64decode(self.data)).decode('utf-8')
+
 
 class Domain(models.Model):
     """Model for representing a domain name."""
@@ -256,3 +445,16 @@ class Domain(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class SearchShard(models.Model):
+    """Model for representing a shard of the index of all public docs."""
+    # Position of this shard, from the ids of its projects
+    number = models.PositiveIntegerField(unique=True)
+    # Stored index of the pages of this shard's public projects
+    index = models.CharField(max_length=255, blank=True)
+    # Last modified date
+    mod_date = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return 'Search shard %s' % self.number
@@ -1,16 +1,71 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from django.test import TestCase
 
-Replace this with more appropriate tests for your application.
-"""
+from hasdocs.accounts.models import OthersPermission, User
+from hasdocs.projects.models import Project
 
-from django.test import TestCase
 
+def repo_data(id, login, name, private=False, description='Docs'):
+    """Returns the data of a GitHub repo as listed by its API."""
+    return {
+        'id': id, 'name': name, 'description': description,
+        'private': private, 'language': None,
+        'html_url': 'https://github.com/%s/%s' % (login, name),
+        'git_url': 'git://github.com/%s/%s.git' % (login, name),
+    }
+
+
+class SyncReposTest(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(login='alice')
+        self.bob = User.objects.create(login='bob')
+
+    def others_paths(self):
+        return sorted(OthersPermission.objects.values_list('path', flat=True))
+
+    def test_create_and_update(self):
+        """Tests that only new and changed repos are written."""
+        repos = [repo_data(1, 'alice', 'one'),
+                 repo_data(2, 'alice', 'two', private=True)]
+        self.assertEqual(Project.objects.sync_repos(self.alice, repos),
+                         (2, 0, set()))
+        self.assertEqual(Project.objects.sync_repos(self.alice, repos),
+                         (0, 0, set()))
+        repos[0]['description'] = None
+        self.assertEqual(Project.objects.sync_repos(self.alice, repos),
+                         (0, 1, set()))
+        self.assertEqual(Project.objects.get(pk=1).description, '')
+        self.assertEqual(Project.objects.get(pk=2).owner_id, self.alice.pk)
+
+    def test_others_permissions(self):
+        """Tests that everyone can read the public repos only."""
+        repos = [repo_data(1, 'alice', 'one'),
+                 repo_data(2, 'alice', 'two', private=True)]
+        Project.objects.sync_repos(self.alice, repos)
+        self.assertEqual(self.others_paths(), ['/alice/one/'])
+        repos[0]['private'] = True
+        repos[1]['private'] = False
+        Project.objects.sync_repos(self.alice, repos)
+        self.assertEqual(self.others_paths(), ['/alice/two/'])
+
+    def test_transfer(self):
+        """Tests that the old owner's path is cleaned up on a transfer."""
+        Project.objects.sync_repos(self.alice, [repo_data(1, 'alice', 'one')])
+        self.assertEqual(
+            Project.objects.sync_repos(self.bob, [repo_data(1, 'bob', 'one')]),
+            (0, 1, set()))
+        self.assertEqual(Project.objects.get(pk=1).owner_id, self.bob.pk)
+        self.assertEqual(self.others_paths(), ['/bob/one/'])
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+    def test_stale_search_shards(self):
+        """Tests that the projects whose docs are listed stale are returned."""
+        Project.objects.sync_repos(self.alice, [repo_data(1, 'alice', 'one'),
+                                                repo_data(2, 'alice', 'two')])
+        Project.objects.filter(pk=1).update(search_index='index/1.json')
+        repos = [repo_data(1, 'alice', 'one', private=True),
+                 repo_data(2, 'alice', 'two', private=True)]
+        self.assertEqual(Project.objects.sync_repos(self.alice, repos),
+                         (0, 2, set([1])))
+        # Private docs are not listed anyway
+        self.assertEqual(Project.objects.sync_repos(
+            self.bob, [repo_data(1, 'bob', 'one', private=True)]),
+            (0, 1, set()))
@@ -4,17 +4,19 @@ import requests
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.views.generic import DetailView, View
 from django.views.generic.edit import DeleteView, UpdateView
 from django.views.generic.list import ListView
 
 from hasdocs.accounts.mixins import PermissionRequiredMixin
+from hasdocs.core import github
 from hasdocs.core.tasks import update_docs
 from hasdocs.core.views import serve
 from hasdocs.projects.forms import ProjectActivateForm
-from hasdocs.projects.models import Build, Generator, Language, Project
+from hasdocs.projects.models import Build, Generator, Language, LogChunk, \
+    Project
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +49,7 @@ class ProjectActivate(PermissionRequiredMixin, ProjectMixin, UpdateView):
         create_hook_github(self.request, self.object)
         self.object.active = True
         # Initiates first build
-        self.build = update_docs(self.object)
+        self.build = update_docs(self.object, priority=Build.INTERACTIVE)
         logger.info('Created hook for %s/%s' % (
             self.kwargs['username'], self.kwargs['project']))
         return super(ProjectActivate, self).form_valid(form)
@@ -93,7 +95,7 @@ class ProjectBuildList(ListView):
         return Build.objects.filter(
             project__owner__login=self.kwargs['username'],
             project__name=self.kwargs['project']
-        )
+        ).defer('output')
 
     def get_context_data(self, **kwargs):
         """Sets the list of Heroku apps as context."""
@@ -109,6 +111,27 @@ class ProjectBuildDetail(PermissionRequiredMixin, DetailView):
     required_permission = 'read'
 
 
+class ProjectBuildLog(PermissionRequiredMixin, View):
+    """View for returning a page of the output from a build."""
+    required_permission = 'read'
+
+    def get(self, request, *args, **kwargs):
+        """Returns the requested chunk of the output as plain text."""
+        try:
+            number = int(request.GET.get('page', 0))
+        except ValueError:
+            raise Http404
+        chunk = get_object_or_404(
+            LogChunk, build__pk=self.kwargs['pk'],
+            build__project__owner__login=self.kwargs['username'],
+            build__project__name=self.kwargs['project'], number=number)
+        response = HttpResponse(chunk.text(),
+                                content_type='text/plain; charset=utf-8')
+        response['X-Log-Pages'] = LogChunk.objects.filter(
+            build=chunk.build_id).count()
+        return response
+
+
 class ProjectDocs(View):
     """View for showing the project's built documentation."""
 
@@ -139,7 +162,7 @@ def import_from_heroku(request):
         # Creates a post-receive webhook at GitHub
         create_hook_heroku(request)
         # Build docs for the first time
-        update_docs(project)
+        update_docs(project, priority=Build.INTERACTIVE)
         return HttpResponseRedirect(
             reverse('project_detail', args=[request.user, project]))
     else:
@@ -153,9 +176,10 @@ def create_hook_github(request, project):
     url = request.build_absolute_uri(reverse('github_hook'))
     config = {'url': url}
     payload = {'name': 'web', 'config': config}
-    r = requests.post('%s/repos/%s/%s/hooks' % (
-        settings.GITHUB_API_URL, project.owner.login, project.name
-    ), data=json.dumps(payload), params={'access_token': access_token})
+    r = github.request('POST', '/repos/%s/%s/hooks' % (
+        project.owner.login, project.name
+    ), params={'access_token': access_token}, data=json.dumps(payload),
+        reserve=0)
     logger.info('Received %s from GitHub for %s' % (r, project.name))
     return r
 
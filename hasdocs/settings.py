@@ -286,6 +286,20 @@ GITHUB_CLIENT_SECRET = os.environ['GITHUB_CLIENT_SECRET']
 GITHUB_AUTHORIZE_URL = 'https://github.com/login/oauth/authorize'
 GITHUB_ACCESS_TOKEN_URL = 'https://github.com/login/oauth/access_token'
 GITHUB_API_URL = 'https://api.github.com'
+# Secret GitHub signs the events of webhooks with, which are refused without
+GITHUB_WEBHOOK_SECRET = os.environ.get('GITHUB_WEBHOOK_SECRET', '')
+# Pages of a listing fetched from GitHub's API at a time
+GITHUB_API_CONCURRENCY = 8
+# Seconds a page from GitHub's API is cached for revalidation
+GITHUB_API_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+# Requests of each token's hourly budget left to the requests users wait
+# for, and how rate limited tasks are retried, in seconds
+GITHUB_API_RESERVE = 500
+GITHUB_API_RETRIES = 5
+GITHUB_API_BACKOFF = 60
+GITHUB_API_JITTER = 60
+# Tasks syncing the teams of an organization in parallel
+GITHUB_TEAM_SYNC_CONCURRENCY = 4
 
 # Heroku
 HEROKU_API_URL = 'https://api.heroku.com'
@@ -293,6 +307,10 @@ HEROKU_API_KEY = os.environ['HEROKU_API_KEY']
 
 # Celery
 BROKER_URL = 'django://'
+# Results are only kept for the tasks that ask for it, such as the tasks
+# joined by a chord
+CELERY_RESULT_BACKEND = 'database'
+CELERY_IGNORE_RESULT = True
 
 import djcelery
 djcelery.setup_loader()
@@ -310,9 +328,85 @@ PUSHER_APP_ID = os.environ['PUSHER_APP_ID']
 PUSHER_API_KEY = os.environ['PUSHER_API_KEY']
 PUSHER_API_SECRET = os.environ['PUSHER_API_SECRET']
 
+# Prefix of the stored artifacts that are not served as docs
+ARTIFACTS_PREFIX = '_hasdocs'
+
 # Virtualenv
-VENV_NAME = 'venv'
-VENV_FILENAME = '.venv.tar.gz'
+VENV_PYTHON = 'python2.7'
+VENV_ROOT = os.path.join(PROJECT_ROOT, 'venvs')
+VENV_MARKER = '.hasdocs-complete'
+# Seconds a virtualenv is kept on a worker after it was last used
+VENV_LOCAL_AGE = 7 * 24 * 60 * 60
+
+# Manifest of the sources stored with the Sphinx environment
+SPHINX_MANIFEST = '.hasdocs-sources.json'
+
+# Wheels shared by the builds of each owner on a worker, which are removed
+# once unused for WHEEL_LOCAL_AGE seconds, and an optional local package index
+WHEEL_DIR = os.environ.get('WHEEL_DIR', os.path.join(PROJECT_ROOT, 'wheels'))
+WHEEL_LOCAL_AGE = 7 * 24 * 60 * 60
+PACKAGE_INDEX_DIR = os.environ.get('PACKAGE_INDEX_DIR', '')
+
+# Builds, which are extracted under BUILD_ROOT and check every
+# BUILD_SUPERSEDED_INTERVAL seconds whether they were superseded
+BUILD_CONCURRENCY = int(os.environ.get('BUILD_CONCURRENCY', 4))
+BUILD_OWNER_CONCURRENCY = 1
+BUILD_SCHEDULER_SCAN = 1000
+# Seconds the lock of the scheduler is held for at most
+BUILD_SCHEDULER_LOCK_TIMEOUT = 5 * 60
+BUILD_TIMEOUT = 60 * 60
+BUILD_ROOT = os.path.join(PROJECT_ROOT, 'builds')
+BUILD_SUPERSEDED_INTERVAL = 5
+# Times a stage is retried after a transient error, doubling the delay
+# between the attempts from BUILD_RETRY_DELAY seconds
+BUILD_STAGE_RETRIES = 3
+BUILD_RETRY_DELAY = 10
+
+# Publishing the docs of a build as one archive and an index of its files,
+# rather than as separate files. It is off unless the environment turns it
+# on, which is done once every web process can serve archives
+DOCS_PUBLISH_ARCHIVES = bool(os.environ.get('DOCS_PUBLISH_ARCHIVES'))
+# Files stored once by their content hash, as they are often the same in
+# many projects
+DOCS_BLOB_EXTENSIONS = ('.css', '.js', '.eot', '.otf', '.svg', '.ttf',
+                        '.woff', '.gif', '.ico', '.jpg', '.png')
+# Archive and search indexes kept in memory by each process
+DOCS_ARCHIVE_INDEXES = 100
+# Archived files and indexes never change, so they are cached for long
+DOCS_ARCHIVE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Full-text search of the docs, where the words of a page's title weigh more
+# than the words of its text
+SEARCH_TITLE_WEIGHT = 5
+SEARCH_MAX_WORD_LENGTH = 50
+# Terms a word ending with an asterisk may match
+SEARCH_MAX_EXPANSIONS = 50
+SEARCH_MAX_RESULTS = 50
+# Global search over all public docs, whose index is sharded by project. A
+# shard is updated at most once every SEARCH_SHARD_DELAY seconds, and the
+# results of a query are cached until a shard is updated.
+SEARCH_SHARDS = 16
+SEARCH_SHARD_DELAY = 60
+SEARCH_SHARD_RETRIES = 5
+# Shards read at a time by a query
+SEARCH_SHARD_CONCURRENCY = 8
+SEARCH_MAX_RANKED = 1000
+SEARCH_CACHE_TIMEOUT = 10 * 60
+
+# Garbage collection of stored docs and artifacts, keeping anything newer
+# than the grace period and virtualenvs used in the last 30 days
+DOCS_GC_DRY_RUN = bool(os.environ.get('DOCS_GC_DRY_RUN'))
+DOCS_GC_GRACE_PERIOD = 24 * 60 * 60
+DOCS_GC_VIRTUALENV_AGE = 30 * 24 * 60 * 60
+DOCS_GC_BATCH_SIZE = 500
+DOCS_GC_BATCH_DELAY = 1
+DOCS_GC_MAX_DELETES = 100000
+
+# Build logs
+BUILD_LOG_FLUSH_INTERVAL = 1
+BUILD_LOG_FLUSH_SIZE = 8 * 1024
+BUILD_LOG_CHUNK_SIZE = 64 * 1024
+BUILD_LOG_TAIL_SIZE = 16 * 1024
 
 # Gravatar
 GRAVATAR_API_URL = 'https://secure.gravatar.com/avatar'
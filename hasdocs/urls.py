@@ -8,7 +8,8 @@ from hasdocs.accounts.views import BillingUpdate, ConnectionsUpdate, \
     ProfileUpdate, UserDetail
 from hasdocs.core.views import ArticleDetail, Contact, Plans
 from hasdocs.projects.views import  ProjectBuildDetail, ProjectBuildList, \
-    ProjectActivate, ProjectDelete, ProjectDetail, ProjectList, ProjectUpdate
+    ProjectBuildLog, ProjectActivate, ProjectDelete, ProjectDetail, \
+    ProjectList, ProjectUpdate
 
 admin.autodiscover()
 
@@ -46,6 +47,8 @@ urlpatterns = patterns(
 
     # Explore
     url(r'^explore/$', ProjectList.as_view(), name='explore'),
+    # Search of all public docs
+    url(r'^search/$', 'hasdocs.core.views.search_all', name='search'),
     # How it works
     url(r'^how/$', TemplateView.as_view(template_name='content/how.html'),
         name='how'),
@@ -74,6 +77,9 @@ urlpatterns = patterns(
     # GitHub post-receive hook
     url(r'^post-receive/github/$', 'hasdocs.core.views.post_receive_github',
         name='github_hook'),
+    # GitHub hook for the events of accounts and repos
+    url(r'^post-receive/github/events/$',
+        'hasdocs.accounts.views.github_event', name='github_event_hook'),
     # Heroku http deploy hook
     url(r'^post-receive/heroku/$', 'hasdocs.core.views.post_receive_heroku',
         name='heroku_hook'),
@@ -111,6 +117,9 @@ urlpatterns = patterns(
     # Build detail
     url(r'^(?P<username>[\w-]+)/(?P<project>[\w.-]+)/builds/(?P<pk>\d+)/$',
         ProjectBuildDetail.as_view(), name='project_build_detail'),
+    # Pages of the output from a build
+    url(r'^(?P<username>[\w-]+)/(?P<project>[\w.-]+)/builds/(?P<pk>\d+)/log/$',
+        ProjectBuildLog.as_view(), name='project_build_log'),
 )
 
 if settings.DEBUG: